@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 
 from . import command_codes as cc
+from .dispatch import CommandIndex, HandlerIndex, MessageIndex, Registration, StopDispatch, WaiterTable
+from .executor import HandlerPool, ProcessOffload, TaskRegistry, ThreadOffload
+from .parser import IrcMessage, parse_line, parse_message
+from .profiler import HandlerProfiler
+from .protocol import IrcProtocol
+from .util import split_encoded
+from .sendqueue import SendQueue, TokenBucket, PRIORITY_CRITICAL, command_priority, command_target
+from .trafficlog import TrafficLog
 
 import asyncio
 from collections import namedtuple
+import inspect
 import logging
 import re
-from typing import List, Callable, Union, Sequence, Any
-from types import coroutine
+from time import perf_counter
+from typing import List, Callable, Union, Sequence, Any, Optional, Tuple
+from types import MappingProxyType, coroutine
 
 
 class LoggerMetaClass(type):
@@ -15,12 +25,18 @@ class LoggerMetaClass(type):
     def __new__(mcs, name, bases, namespace):
         inst = type.__new__(mcs, name, bases, namespace)
         inst._log = logging.getLogger("bot.{}".format(name))
-        inst._log.debug("Attached logger to {}".format(name))
+        inst._log.debug("Attached logger to %s", name)
         return inst
 
 
 RegEx = type(re.compile(""))
 
+# shared result of message matchers without groups, read-only so it can't leak state
+NO_GROUPS = MappingProxyType({})
+
+# `Message` sender or recipient that hasn't been looked up yet
+_UNRESOLVED = object()
+
 
 class User(metaclass=LoggerMetaClass):
 
@@ -29,7 +45,7 @@ class User(metaclass=LoggerMetaClass):
         self.hostmask = hostmask
         self.client = client
 
-        self._log.debug("Created {}".format(self))
+        self._log.debug("Created %s", self)
 
     async def message(self, text: str, notice: bool=False) -> None:
         await self.client.message(self.name, text, notice=notice)
@@ -51,7 +67,7 @@ class Channel(metaclass=LoggerMetaClass):
         self.client = client
         self.users = set()
 
-        self._log.debug("Created {}".format(self))
+        self._log.debug("Created %s", self)
 
     def on_message(self, *args, accept_query=False, matcher=None, **kwargs):
         """
@@ -65,7 +81,7 @@ class Channel(metaclass=LoggerMetaClass):
                     ret = matcher(msg)
                     if ret is None or ret is False:
                         return ret
-                if msg.recipient is not self and not isinstance(msg.sender, User):
+                if msg.channel_name != self.name and msg.sender_name is None:
                     return False
                 return ret
         else:
@@ -94,6 +110,13 @@ class Channel(metaclass=LoggerMetaClass):
 
 
 class Message(metaclass=LoggerMetaClass):
+    """
+    A PRIVMSG or NOTICE. `sender_name` (`None` for server messages) and
+    `channel_name` (`None` for queries) are plain strings; `sender` and
+    `recipient` are the `User` and `Channel` objects. For received messages
+    they're only looked up (or created) on first access while matching, or
+    else when the message is handed to a handler or waiter
+    """
 
     def __init__(self, sender: Union[User, Channel],
                  recipient: Union[User, Channel],
@@ -103,10 +126,58 @@ class Message(metaclass=LoggerMetaClass):
         self.text = text
         self.notice = notice
 
+    @classmethod
+    def _from_irc(cls, client: 'Client', msg: IrcMessage) -> 'Message':
+        """
+        Message for a received PRIVMSG or NOTICE line, resolving its sender and
+        recipient lazily
+        """
+        message = cls.__new__(cls)
+        message._client = client
+        message._prefix = prefix = msg.prefix
+        message._target = target = msg.args[1]
+        message._sender = message._recipient = _UNRESOLVED
+        # same rules as `Client._resolve_sender` and `Client._resolve_recipient`
+        message.sender_name = prefix.partition("!")[0] if "!" in prefix and "@" in prefix else None
+        message.channel_name = target if target[0] in client._channel_types else None
+        message.text = msg.args[2]
+        message.notice = msg.args[0] == cc.NOTICE
+        return message
+
+    def _resolve(self) -> None:
+        """
+        Look up the sender and recipient now, on the event loop and while they're
+        current, as handlers may run later or in a thread
+        """
+        self.sender
+        self.recipient
+
+    @property
+    def sender(self) -> Optional[User]:
+        if self._sender is _UNRESOLVED:
+            self._sender = self._client._resolve_sender(self._prefix)
+        return self._sender
+
+    @sender.setter
+    def sender(self, sender: Optional[User]) -> None:
+        self._sender = sender
+        self.sender_name = sender.name if sender is not None else None
+
+    @property
+    def recipient(self) -> Union[User, Channel]:
+        if self._recipient is _UNRESOLVED:
+            self._recipient = self._client._resolve_recipient(self._target)
+        return self._recipient
+
+    @recipient.setter
+    def recipient(self, recipient: Union[User, Channel]) -> None:
+        self._recipient = recipient
+        self.channel_name = recipient.name if isinstance(recipient, Channel) else None
+
     async def reply(self, text: str, notice: bool=None) -> None:
         if notice is None:
             notice = self.notice
-        recipient = self.recipient if isinstance(self.recipient, Channel) else self.sender
+        recipient = self.recipient if self.channel_name is not None else self.sender
         await recipient.message(text, notice=notice)
 
     def __repr__(self):
@@ -117,7 +188,40 @@ class Client(metaclass=LoggerMetaClass):
 
     def __init__(self, host: str, port: int, nick: str="TheBot", user: str="bot",
                  realname: str="The Bot", secure: bool=False, encoding: str="utf-8",
-                 password: str=None):
+                 password: str=None, transport_mode: str="protocol",
+                 flood_control: TokenBucket=None, send_queue_size: int=256,
+                 coalesce_writes: bool=True, handler_pool: HandlerPool=None,
+                 blocking_workers: int=4, process_workers: int=2,
+                 handler_timeout: float=None, drain_timeout: float=0,
+                 profiler: HandlerProfiler=None, traffic_log: TrafficLog=None):
+        """
+        :param transport_mode: "protocol" to read through `IrcProtocol`, which hands
+                               received lines to the dispatcher in batches, or "stream"
+                               to fall back to reading line by line from a `StreamReader`
+        :param flood_control: `TokenBucket` limiting the rate of outgoing lines,
+                              `None` to send as fast as the connection allows
+        :param send_queue_size: number of outgoing lines that can be queued before
+                                sending (e.g. `message`) blocks
+        :param coalesce_writes: write all lines queued within one event loop iteration
+                                to the transport at once instead of line by line
+        :param handler_pool: `HandlerPool` bounding the number of running and queued
+                             message and join handlers, `None` to start a task for
+                             every handler call without limit. An ordered pool runs
+                             the handlers for each channel (or query) in order
+        :param blocking_workers: number of threads running blocking handlers
+        :param process_workers: number of processes running CPU-heavy commands
+        :param handler_timeout: default number of seconds after which message and
+                                join handlers and commands are cancelled, `None` for
+                                no limit
+        :param drain_timeout: seconds the client's background tasks (handlers etc.)
+                              get to finish once the connection is closed, before
+                              they're cancelled
+        :param profiler: `HandlerProfiler` recording the cost of every message and
+                         join handler, `None` to not take any timings
+        :param traffic_log: `TrafficLog` logging a sample of the lines sent and received
+        """
+        if transport_mode not in ("protocol", "stream"):
+            raise ValueError("Unknown transport_mode={}".format(transport_mode))
         self.host = host
         self.port = port
         self.secure = secure
@@ -126,19 +230,42 @@ class Client(metaclass=LoggerMetaClass):
         self.realname = realname
         self.encoding = encoding
         self.password = password
+        self.transport_mode = transport_mode
+        self.flood_control = flood_control
+        self.send_queue_size = send_queue_size
+        self.coalesce_writes = coalesce_writes
+        self.drain_timeout = drain_timeout
+        self.profiler = profiler
+        self.traffic_log = traffic_log
+        self._tasks = TaskRegistry()
+        self.handler_pool = handler_pool
+        if handler_pool is not None and handler_pool.registry is None:
+            handler_pool.registry = self._tasks
+        self._threads = ThreadOffload(blocking_workers)
+        self._processes = ProcessOffload(process_workers)
+        self.handler_timeout = handler_timeout
+        self._handler_timeouts = 0
 
         self._on_connected_handlers = []
-        self._on_message_handlers = []
+        self._on_message_handlers = MessageIndex()
         self._users = {}
         self._channels = {}
-        self._on_command_handlers = []
-        self._on_join_handlers = []
+        self._on_command_handlers = CommandIndex()
+        self._on_join_handlers = HandlerIndex()
+        self._message_waiters = WaiterTable()
+        self._command_waiters = WaiterTable()
         # default chan types, can be overridden by `cc.RPL_ISUPPORT` CHANTYPES
         self._channel_types = "#&"
         # default user mode prefixes, can be overridden by `cc.RPL_ISUPPORT` PREFIX
         self._prefix_map = {"@": "o", "+": "v"}
+        # targets per command from `cc.RPL_ISUPPORT` TARGMAX, `None` for no limit
+        self._target_limits = {}
+        # `cc.RPL_ISUPPORT` MAXTARGETS, used for commands missing in TARGMAX
+        self._max_targets = None
         self._connected = False
         self._modules = []
+        # our own nick!user@host as relayed by the server, learned from our JOINs
+        self._relay_prefix = None
 
         # Register JOIN, QUIT, PART, NICK handlers
         self.on_command(cc.JOIN)(self._on_join)
@@ -153,214 +280,284 @@ class Client(metaclass=LoggerMetaClass):
 
         return decorator
 
-    MessageHandler = namedtuple("MessageHandler", ("matcher", "handler"))
+    MessageHandler = namedtuple("MessageHandler", ("matcher", "handler", "regex", "stop", "run", "timeout"))
 
     def on_message(self, message: Union[str, RegEx]=None, channel: Union[str, RegEx]=None,
                    sender: Union[str, RegEx]=None, matcher: Callable[[Message], None]=None,
-                   notice: bool=None) -> Callable[[Callable], Callable]:
+                   notice: bool=None, blocking: bool=None, timeout: float=None,
+                   priority: int=0, stop: bool=False) -> Callable[[Callable], Callable]:
         """
 
         Register a handler that's called after a message is received (PRIVMSG, NOTICE).
-        The handler is called with the `Message` as argument, must be a coroutine
-        and is run non-blocking. All filters must match for a message to be accepted.
+        The handler is called with the `Message` as argument and is run non-blocking:
+        coroutines as a task, blocking functions in a thread (see `blocking`).
+        All filters must match for a message to be accepted.
         :param message: message filter, string (exact match) or compiled regex object
         :param channel: channel filter, string (exact match) or compiled regex object
         :param sender: sender filter, string (exact match) or compiled regex object
         :param matcher: test function, return true to accept the message.
                         Gets the `Message` as parameter
+        :param blocking: run the handler in a thread, `None` to do so unless it's
+                         a coroutine function
+        :param timeout: seconds after which the handler is cancelled, `None` for the
+                        client's `handler_timeout`, 0 for no limit. Blocking handlers
+                        can't be stopped, their thread keeps running
+        :param priority: handlers with a higher priority are matched and started first,
+                         equal priorities in registration order
+        :param stop: if the message matches, don't pass it on to the handlers after
+                     this one. A matcher can also raise `StopDispatch` to drop the
+                     message without starting its own handler
         """
-        matchers = []
+        def decorator(fn: Callable[[Message], None]) -> Callable[[Message], None]:
+            self.add_message_handler(fn, message=message, channel=channel, sender=sender,
+                                     matcher=matcher, notice=notice, blocking=blocking,
+                                     timeout=timeout, priority=priority, stop=stop)
+            return fn
 
-        if notice is not None:
-            def notice_matcher(msg: Message) -> bool:
-                return msg.notice == notice
-            matchers.append(notice_matcher)
+        return decorator
 
-        if matcher:
-            matchers.append(matcher)
+    def add_message_handler(self, handler: Callable[[Message], None],
+                            message: Union[str, RegEx]=None, channel: Union[str, RegEx]=None,
+                            sender: Union[str, RegEx]=None, matcher: Callable[[Message], None]=None,
+                            notice: bool=None, blocking: bool=None, timeout: float=None,
+                            priority: int=0, stop: bool=False) -> Registration:
+        """
+        Non-decorator version of `on_message`, returns a `Registration` that can
+        be removed in O(1)
+        """
+        run = self._handler_runner(handler, blocking)
+        message_matcher, regex, bucket, key = self._build_message_matcher(
+            message, channel, sender, matcher, notice)
+        mh = self.MessageHandler(message_matcher, handler, regex, stop, run, timeout)
+        reg = self._on_message_handlers.add(mh, bucket, key, priority)
+        self._log.debug("Added message handler %s", mh)
+        return reg
+
+    def _build_message_matcher(self, message: Union[str, RegEx]=None, channel: Union[str, RegEx]=None,
+                               sender: Union[str, RegEx]=None, matcher: Callable[[Message], None]=None,
+                               notice: bool=None) -> tuple:
+        """
+        Turn the `on_message` filters into `(matcher, regex, bucket, key)`: the
+        matcher for all filters, the message regex (if any) for the literal
+        prefilters of `MessageIndex`, and the bucket and key to index the handler
+        under. The matcher is generated as a single function with only the checks
+        this registration needs. It returns `None` if the message doesn't match,
+        else the groups to pass to the handler (`NO_GROUPS` if there are none):
+        the custom matcher's, then the message, sender and channel regexes'.
+        """
+        # checks in evaluation order: equality tests first, then regex searches,
+        # then the custom matcher as it can be arbitrarily expensive
+        checks = []
+        env = {"NO_GROUPS": NO_GROUPS}
+        # expressions of the group dicts to pass to the handler, later ones win;
+        # the custom matcher's go first although it's checked last
+        groups = []
+
+        if notice is not None:
+            env["notice"] = bool(notice)
+            checks.append("if msg.notice != notice: return None")
 
         # message
+        regex = None
         if message is None:
             pass
         elif isinstance(message, str):
-            def matcher(msg: Message) -> bool:
-                return msg.text == message
-
-            matchers.append(matcher)
+            env["text"] = message
+            checks.append("if msg.text != text: return None")
         elif hasattr(message, "search"):
-            # regex or so
-            def matcher(msg: Message) -> bool:
-                m = message.search(msg.text)
-                if m is not None:
-                    return m.groupdict()
-
-            matchers.append(matcher)
+            # regex or so, searched after the equality tests
+            regex = message
         else:
             raise ValueError("Don't know what to do with message={}".format(message))
 
-        # sender
-        if sender is None:
+        # channel and sender equality
+        if channel is None or hasattr(channel, "search"):
             pass
-        elif isinstance(sender, User):
-            def matcher(msg: Message) -> bool:
-                return msg.sender == sender
-
-            matchers.append(matcher)
-        elif isinstance(sender, str):
-            def matcher(msg: Message) -> bool:
-                return msg.sender.name == sender
-
-            matchers.append(matcher)
-        elif hasattr(sender, "search"):
-            # regex or so
-            def matcher(msg: Message) -> bool:
-                m = sender.search(msg.sender.name)
-                if m is not None:
-                    return m.groupdict()
-
-            matchers.append(matcher)
+        elif isinstance(channel, (Channel, str)):
+            env["channel_name"] = getattr(channel, "name", channel)
+            checks.append("if msg.channel_name != channel_name: return None")
         else:
-            raise ValueError("Don't know what to do with sender={}".format(sender))
+            raise ValueError("Don't know what to do with channel={}".format(channel))
 
-        # channel
-        if channel is None:
+        if sender is None or hasattr(sender, "search"):
             pass
-        elif isinstance(channel, Channel):
-            def matcher(msg: Message) -> bool:
-                return isinstance(msg.recipient, Channel) \
-                       and msg.recipient == channel
-
-            matchers.append(matcher)
-        elif isinstance(channel, str):
-            def matcher(msg: Message) -> bool:
-                return isinstance(msg.recipient, Channel) \
-                       and msg.recipient.name == channel
-
-            matchers.append(matcher)
-        elif hasattr(channel, "search"):
-            # regex or so
-            def matcher(msg: Message) -> bool:
-                if not isinstance(msg.recipient, Channel):
-                    return
-                m = channel.search(msg.recipient.name)
-                if m is not None:
-                    return m.groupdict()
-
-            matchers.append(matcher)
+        elif isinstance(sender, User):
+            # compared by its current name, which follows the user's nick changes
+            env["sender_user"] = sender
+            checks.append("if msg.sender_name != sender_user.name: return None")
+        elif isinstance(sender, str):
+            env["sender_name"] = sender
+            checks.append("if msg.sender_name != sender_name: return None")
         else:
-            raise ValueError("Don't know what to do with channel={}".format(channel))
+            raise ValueError("Don't know what to do with sender={}".format(sender))
 
-        def message_matcher(msg: Message) -> bool:
-            fn_kwargs = {}
-            for m in matchers:
-                ret = m(msg)
-                # Internal matchers may return False or None to fail
-                if ret is None or ret is False:
-                    return
-                # If one returns a dict the values in it will be passed to the handler
-                if isinstance(ret, dict):
-                    fn_kwargs.update(ret)
-            return fn_kwargs
+        # message, sender and channel regexes
+        if regex is not None:
+            env["message_re"] = regex
+            checks.append("message_match = message_re.search(msg.text)")
+            checks.append("if message_match is None: return None")
+            if regex.groupindex:
+                groups.append("message_match.groupdict()")
+
+        if hasattr(sender, "search"):
+            env["sender_re"] = sender
+            checks.append("sender = msg.sender_name")
+            checks.append("if sender is None: return None")
+            checks.append("sender_match = sender_re.search(sender)")
+            checks.append("if sender_match is None: return None")
+            if sender.groupindex:
+                groups.append("sender_match.groupdict()")
+
+        if hasattr(channel, "search"):
+            env["channel_re"] = channel
+            checks.append("channel = msg.channel_name")
+            checks.append("if channel is None: return None")
+            checks.append("channel_match = channel_re.search(channel)")
+            checks.append("if channel_match is None: return None")
+            if channel.groupindex:
+                groups.append("channel_match.groupdict()")
 
-        def decorator(fn: Callable[[Message], None]) -> Callable[[Message], None]:
-            mh = self.MessageHandler(message_matcher, fn)
-            self._on_message_handlers.append(mh)
-            self._log.debug("Added message handler {} with matchers {}".format(mh, matchers))
-            return fn
+        if matcher:
+            env["matcher"] = matcher
+            checks.append("custom = matcher(msg)")
+            # Custom matchers may return False or None to fail
+            checks.append("if custom is None or custom is False: return None")
+            # If one returns a dict the values in it will be passed to the handler
+            groups.insert(0, "custom if isinstance(custom, dict) else NO_GROUPS")
+
+        if not groups:
+            checks.append("return NO_GROUPS")
+        elif len(groups) == 1:
+            checks.append("return " + groups[0])
+        else:
+            checks.append("kwargs = dict({})".format(groups[0]))
+            checks.extend("kwargs.update({})".format(group) for group in groups[1:])
+            checks.append("return kwargs")
+
+        source = "def message_matcher(msg):\n" + "".join("    {}\n".format(check) for check in checks)
+        exec(compile(source, "<on_message matcher>", "exec"), env)
+        message_matcher = env["message_matcher"]
+
+        # index on the cheapest exact-match filter so dispatch can skip this handler
+        if isinstance(message, str):
+            bucket, key = MessageIndex.TEXT, message
+        elif isinstance(channel, (str, Channel)):
+            bucket, key = MessageIndex.CHANNEL, getattr(channel, "name", channel)
+        elif isinstance(sender, str):
+            bucket, key = MessageIndex.SENDER, sender
+        else:
+            bucket, key = None, None
 
-        return decorator
+        return message_matcher, regex, bucket, key
 
     def remove_message_handler(self, handler: Callable[[Message], None]) -> None:
-        for mh in self._on_message_handlers:
-            if mh.handler == handler:
-                self._log.debug("Removing message handler {}".format(mh))
-                self._on_message_handlers.remove(mh)
+        for mh in self._on_message_handlers.remove(handler):
+            self._log.debug("Removing message handler %s", mh)
 
-    def await_message(self, *args, **kwargs) -> 'asyncio.Future[Message]':
+    def await_message(self, *args, timeout: float=None, **kwargs) -> 'asyncio.Future[Message]':
         """
-        Block until a message matches. See `on_message`
+        Block until a message matches. See `on_message` for the filters.
+        Waiters live in a table separate from the message handlers, keyed on the
+        exact-match filter like `MessageIndex`, and are dropped as soon as they
+        resolve, time out or are cancelled.
+        :param timeout: fail the future with `asyncio.TimeoutError` after this many seconds
         """
-        fut = asyncio.Future()
-        @self.on_message(*args, **kwargs)
-        async def handler(message):
-            fut.set_result(message)
-        # remove handler when done or cancelled
-        fut.add_done_callback(lambda _: self.remove_message_handler(handler))
-        return fut
+        message_matcher, regex, bucket, key = self._build_message_matcher(*args, **kwargs)
 
-    IrcMessage = namedtuple("IrcMessage", ("prefix", "args"))
+        def predicate(message: Message) -> bool:
+            if message_matcher(message) is None:
+                return False
+            message._resolve()
+            return True
+
+        return self._message_waiters.add((bucket, key), predicate, timeout)
 
-    JoinHandler = namedtuple("JoinHandler", ("channel", "handler"))
+    IrcMessage = IrcMessage
 
-    def on_join(self, channel: str=None) -> Callable[[Callable], Callable]:
+    JoinHandler = namedtuple("JoinHandler", ("channel", "handler", "run", "timeout"))
+
+    def on_join(self, channel: str=None, blocking: bool=None,
+                timeout: float=None) -> Callable[[Callable], Callable]:
         """
         Register a handler that's called after a channel is joined.
-        The handler is called with the `Channel` as argument, must be a coroutine
-        and is run non-blocking.
+        The handler is called with the `Channel` as argument and is run
+        non-blocking, like `on_message` handlers.
         :param channel: channel to look out for or `None` for all channels
+        :param blocking: run the handler in a thread, `None` to do so unless it's
+                         a coroutine function
+        :param timeout: seconds after which the handler is cancelled, `None` for the
+                        client's `handler_timeout`, 0 for no limit. Blocking handlers
+                        can't be stopped, their thread keeps running
         """
-        def decorator(fn: Callable[[self.IrcMessage], None]):
-            jh = self.JoinHandler(channel, fn)
-            self._on_join_handlers.append(jh)
-            self._log.debug("Added join handler {}".format(jh))
+        def decorator(fn: Callable[[Channel], None]):
+            self.add_join_handler(fn, channel, blocking=blocking, timeout=timeout)
             return fn
 
         return decorator
 
+    def add_join_handler(self, handler: Callable[[Channel], None], channel: str=None,
+                         blocking: bool=None, timeout: float=None) -> Registration:
+        """
+        Non-decorator version of `on_join`, returns a `Registration` that can
+        be removed in O(1)
+        """
+        jh = self.JoinHandler(channel, handler, self._handler_runner(handler, blocking), timeout)
+        reg = self._on_join_handlers.add(jh)
+        self._log.debug("Added join handler %s", jh)
+        return reg
+
     def remove_join_handler(self, handler: Callable[[Channel], None]) -> None:
-        for jh in self._on_join_handlers:
-            if jh.handler == handler:
-                self._log.debug("Removing join handler {}".format(jh))
-                self._on_join_handlers.remove(jh)
+        for jh in self._on_join_handlers.remove(handler):
+            self._log.debug("Removing join handler %s", jh)
 
-    CommandHandler = namedtuple("CommandHandler", ("args", "handler"))
+    CommandHandler = namedtuple("CommandHandler", ("args", "handler", "stop"))
 
-    def on_command(self, *args: Sequence[str]) -> Callable[[Callable], Callable]:
+    def on_command(self, *args: Sequence[str], priority: int=0,
+                   stop: bool=False) -> Callable[[Callable], Callable]:
         """
         Register a handler that's called when (the beginning of) a `IrcMessage` matches.
         The handler is called with the `IrcMessage` as argument, must be a coroutine
         and is run blocking, i.e. you cannot use `await_command` in it!
         :param args: commands args that must match (the actual command is the first arg)
+        :param priority: handlers with a higher priority are called first, equal
+                         priorities in registration order
+        :param stop: after this handler, skip the remaining command handlers and the
+                     message handlers for the line. The handler can also raise
+                     `StopDispatch` to do so
         """
         def decorator(fn: Callable[[self.IrcMessage], None]):
-            ch = self.CommandHandler(args, fn)
-            self._on_command_handlers.append(ch)
-            self._log.debug("Added command handler {}".format(ch))
+            self.add_command_handler(fn, *args, priority=priority, stop=stop)
             return fn
 
         return decorator
 
+    def add_command_handler(self, handler: Callable[[IrcMessage], None], *args: Sequence[str],
+                            priority: int=0, stop: bool=False) -> Registration:
+        """
+        Non-decorator version of `on_command`, returns a `Registration` that can
+        be removed in O(1)
+        """
+        ch = self.CommandHandler(args, handler, stop)
+        reg = self._on_command_handlers.add(ch, priority)
+        self._log.debug("Added command handler %s", ch)
+        return reg
+
     def remove_command_handler(self, handler: Callable[[IrcMessage], None]) -> None:
-        for ch in self._on_command_handlers:
-            if ch.handler == handler:
-                self._log.debug("Removing command handler {}".format(ch))
-                self._on_command_handlers.remove(ch)
+        for ch in self._on_command_handlers.remove(handler):
+            self._log.debug("Removing command handler %s", ch)
 
-    def await_command(self, *args, **kwargs) -> 'asyncio.Future[IrcMessage]':
+    def await_command(self, *args: Sequence[str], timeout: float=None) -> 'asyncio.Future[IrcMessage]':
         """
         Block until a command matches. See `on_command`
+        Like `await_message` waiters are kept apart from the command handlers,
+        keyed on all of `args`, so a line only reaches the waiters for its own
+        beginning.
+        :param timeout: fail the future with `asyncio.TimeoutError` after this many seconds
         """
-        fut = asyncio.Future()
-        @self.on_command(*args, **kwargs)
-        async def handler(msg):
-            fut.set_result(msg)
-        # remove handler when done or cancelled
-        fut.add_done_callback(lambda _: self.remove_command_handler(handler))
-        return fut
+        return self._command_waiters.add(tuple(args), None, timeout)
 
     def _parsemsg(self, msg: str) -> IrcMessage:
-        # adopted from twisted/words/protocols/irc.py
-        if not msg:
-            return
-        prefix = None
-        if msg[0] == ":":
-            prefix, msg = msg[1:].split(" ", 1)
-        if " :" in msg:
-            msg, rest = msg.split(" :", 1)
-            args = msg.split() + [rest]
-        else:
-            args = msg.split()
-        return self.IrcMessage(prefix, tuple(args))
+        return parse_message(msg)
 
     def _buildmsg(self, *args: List[str], prefix: str=None) -> str:
         msg = ""
@@ -377,84 +574,366 @@ class Client(metaclass=LoggerMetaClass):
         msg += " ".join((fmtarg(i, arg) for i, arg in enumerate(args)))
         return msg
 
-    async def _send(self, *args: List[Any], prefix: str=None) -> None:
+    async def _send(self, *args: List[Any], prefix: str=None, priority: int=None) -> None:
+        """
+        Queue a line for sending.
+        :param priority: send queue lane, see `command_priority` for the default
+        """
         msg = self._buildmsg(*args, prefix=prefix)
-        self._log.debug("<- {}".format(msg))
-        self._writer.write(msg.encode(self.encoding) + b"\r\n")
+        self._log.debug("<- %s", msg)
+        command = str(args[0]).upper()
+        if priority is None:
+            priority = command_priority(command)
+        line = msg.encode(self.encoding) + b"\r\n"
+        if self.traffic_log is not None:
+            self.traffic_log.sent(line, command, str(args[1]) if len(args) > 1 else None)
+        # bulk lines take turns by recipient, control lines stay behind them
+        target = command_target(command, args) if priority != PRIORITY_CRITICAL else None
+        await self._send_queue.put(line, priority, target)
+
+    def stats(self) -> dict:
+        """
+        Runtime counters of the client's queues and pools
+        """
+        stats = {}
+        if getattr(self, "_send_queue", None) is not None:
+            stats["send_queue"] = len(self._send_queue)
+        if self.handler_pool is not None:
+            stats["handler_pool"] = self.handler_pool.stats()
+        stats["threads"] = self._threads.stats()
+        stats["processes"] = self._processes.stats()
+        stats["handlers"] = {"timeouts": self._handler_timeouts}
+        stats["tasks"] = self._tasks.stats()
+        if self.traffic_log is not None:
+            stats["traffic"] = self.traffic_log.stats()
+        return stats
+
+    def profile_snapshot(self) -> List[dict]:
+        """
+        Per handler stats of the `profiler`, see `HandlerProfiler.snapshot`
+        """
+        if self.profiler is None:
+            return []
+        return self.profiler.snapshot()
+
+    def send_queue_depths(self) -> dict:
+        """
+        Number of messages waiting to be sent per recipient, e.g. to spot a backlogged channel
+        """
+        if not getattr(self, "_send_queue", None):
+            return {}
+        return self._send_queue.depths()
 
     async def message(self, recipient: str, text: str, notice: bool=False) -> None:
         """
-        Lower level messaging function used by User and Channel
+        Lower level messaging function used by User and Channel.
+        Text too long for a single line, as relayed by the server, is split into
+        several messages, at spaces where possible.
         """
         # filter newlines and null bytes
         text = text.translate({ord(c): None for c in "\0\n\r"})
-        await self._send(cc.PRIVMSG if not notice else cc.NOTICE, recipient, text)
+        command = cc.PRIVMSG if not notice else cc.NOTICE
+        for chunk in split_encoded(text, self._max_text_bytes(command, recipient), self.encoding):
+            await self._send(command, recipient, chunk)
 
-    async def _get_message(self) -> IrcMessage:
+    async def broadcast(self, targets: Sequence[str], text: str, notice: bool=False) -> None:
+        """
+        Send the same message to several recipients, packing as many of them into
+        each line as the server allows (`cc.RPL_ISUPPORT` TARGMAX or MAXTARGETS).
+        Without either only one recipient per line is used.
+        """
+        command = cc.PRIVMSG if not notice else cc.NOTICE
+        limit = self._target_limit(command)
+        # leave at least half of the line for the text
+        max_bytes = self._max_text_bytes(command, "") // 2
+        group, size = [], 0
+        for target in dict.fromkeys(targets):
+            target_size = len(target.encode(self.encoding))
+            if group and (len(group) == limit or size + 1 + target_size > max_bytes):
+                await self.message(",".join(group), text, notice=notice)
+                group, size = [], 0
+            size += target_size + (1 if group else 0)
+            group.append(target)
+        if group:
+            await self.message(",".join(group), text, notice=notice)
+
+    def _target_limit(self, command: str) -> Optional[int]:
+        """
+        Number of comma-separated targets `command` accepts, `None` for no limit
+        """
+        if command in self._target_limits:
+            return self._target_limits[command]
+        if self._max_targets is not None:
+            return self._max_targets
+        return 1
+
+    # RFC 1459 line length limit, including CR LF
+    MAX_LINE_BYTES = 512
+
+    def _max_text_bytes(self, command: str, recipient: str) -> int:
+        """
+        Bytes left for the text of `command` to `recipient`, as seen by the
+        other clients: ":<our prefix> <command> <recipient> :<text>\r\n"
+        """
+        if self._relay_prefix:
+            prefix = self._relay_prefix
+        else:
+            # not learned yet, assume an ident-less user and the longest host allowed
+            prefix = "{}!~{}@{}".format(self.nick, self.user, "x" * 63)
+        overhead = len(":{} {} {} :\r\n".format(prefix, command, recipient).encode(self.encoding))
+        # leave room for at least some text with absurdly long recipients
+        return max(self.MAX_LINE_BYTES - overhead, 32)
+
+    async def _read_stream_batch(self) -> Optional[List[bytes]]:
+        """
+        `StreamReader` fallback of `IrcProtocol.read_batch`, one line per batch
+        """
         line = await self._reader.readline()
-        line = line.decode(self.encoding).strip("\r\n")
+        if not line:
+            return None
+        return [line]
 
-        if not line and self._reader.at_eof():
-            return
+    async def _get_message(self, line: bytes) -> IrcMessage:
+        msg = parse_line(line, self.encoding)
 
-        self._log.debug("-> {}".format(line))
+        if not msg:
+            return
 
-        msg = self._parsemsg(line)
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug("-> %s", line.decode(self.encoding).rstrip("\r\n"))
+        if self.traffic_log is not None:
+            self.traffic_log.received(line, msg.args[0], msg.args[1] if len(msg.args) > 1 else None)
 
-        if msg and await self._handle_special(msg):
+        if await self._handle_special(msg):
             return
 
         return msg
 
     async def run(self) -> None:
-        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.transport_mode == "protocol":
+            loop = asyncio.get_event_loop()
+            self._writer, protocol = await loop.create_connection(IrcProtocol, self.host, self.port)
+            read_batch = protocol.read_batch
+            drain = protocol.drain
+        else:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            read_batch = self._read_stream_batch
+            drain = self._writer.drain
+
+        self._send_queue = SendQueue(self.send_queue_size)
+        write_task = self._bg(self._write_loop(drain))
+
+        if self.profiler is not None and self.profiler.log_interval:
+            self._bg(self.profiler.log_periodically())
 
         # start connect procedure in the background.
         # messages processed in it actually already go through the main loop below.
         self._bg(self._connect())
 
-        while not self._reader.at_eof():
+        try:
+            while True:
 
-            try:
-                msg = await self._get_message()
-            except:
-                self._log.exception("Error during receiving")
-                raise
+                try:
+                    batch = await read_batch()
+                except:
+                    self._log.exception("Error during receiving")
+                    raise
 
+                if batch is None:
+                    break
 
-            if not msg:
-                continue
+                for line in batch:
+                    try:
+                        msg = await self._get_message(line)
+                    except:
+                        self._log.exception("Error during receiving")
+                        raise
 
-            for ch in self._on_command_handlers:
-                args = msg.args[:len(ch.args)]
-                if ch.args == args:
-                    self._log.debug("Calling command handler {} with input {}".format(ch, msg))
-                    await ch.handler(msg)
+                    if msg:
+                        await self._dispatch(msg)
+        finally:
+            write_task.cancel()
+            self._writer.close()
+            await self._stop_tasks()
 
-            if not self._connected:
-                continue
+        self._log.info("Connection closed, exiting")
+
+    async def _stop_tasks(self) -> None:
+        """
+        Drop queued handler calls, give the live tasks `drain_timeout` seconds
+        and cancel the rest
+        """
+        if self.handler_pool is not None:
+            self.handler_pool.clear()
+        cancelled = await self._tasks.close(self.drain_timeout)
+        if cancelled:
+            self._log.info("Cancelled %s background tasks", cancelled)
 
-            if msg.args[0] in (cc.PRIVMSG, cc.NOTICE):
-                sender = self._resolve_sender(msg.prefix)
-                recipient = self._resolve_recipient(msg.args[1])
-                message = Message(sender, recipient, msg.args[2], (msg.args[0] == cc.NOTICE))
-                await self._handle_on_message(message)
+    async def _write_loop(self, drain: Callable[[], Any]) -> None:
+        """
+        Single writer of the connection: takes lines from the send queue, applies
+        flood control and waits for the transport to drain after every write
+        """
+        queue = self._send_queue
+        bucket = self.flood_control
+        while True:
+            line, priority, target = await queue.get()
+            if bucket:
+                # critical lines go out right away and put the bucket into debt,
+                # others wait for tokens but give way to more urgent lines meanwhile
+                delay = bucket.wait_time(len(line)) if priority != PRIORITY_CRITICAL else 0
+                if delay:
+                    if await queue.wait_urgent(priority, delay, target) or bucket.wait_time(len(line)):
+                        queue.requeue(line, priority, target)
+                        continue
+                bucket.consume(len(line))
+
+            if not self.coalesce_writes:
+                self._writer.write(line)
+                await drain()
                 continue
 
-            # self._log.info("Unhandled command: {} {}".format(command, kwargs))
+            # let everything that's ready to run in this loop iteration queue its lines
+            await asyncio.sleep(0)
+            lines = [line]
+            while True:
+                item = queue.get_nowait()
+                if item is None:
+                    break
+                line, priority, target = item
+                if bucket:
+                    if priority != PRIORITY_CRITICAL and bucket.wait_time(len(line)):
+                        queue.requeue(line, priority, target)
+                        break
+                    bucket.consume(len(line))
+                lines.append(line)
+            self._writer.write(b"".join(lines))
+            await drain()
+
+    async def _dispatch(self, msg: IrcMessage) -> None:
+        stopped = False
+        try:
+            for ch in self._on_command_handlers.matching(msg.args):
+                self._log.debug("Calling command handler %s with input %s", ch, msg)
+                await ch.handler(msg)
+                if ch.stop:
+                    stopped = True
+                    break
+        except StopDispatch:
+            stopped = True
+
+        # waiters see every line, stopped or not
+        if self._command_waiters:
+            args = msg.args
+            self._command_waiters.resolve((args[:length] for length in range(len(args) + 1)), msg)
+
+        if not self._connected:
+            return
 
-        self._writer.close()
+        if msg.args[0] in (cc.PRIVMSG, cc.NOTICE):
+            if stopped and not self._message_waiters:
+                return
+            await self._handle_on_message(Message._from_irc(self, msg), handlers=not stopped)
+            return
 
-        self._log.info("Connection closed, exiting")
+        # self._log.info("Unhandled command: {} {}".format(command, kwargs))
 
-    def _bg(self, coro: coroutine) -> asyncio.Task:
-        """Run coro in background, log errors"""
+    def _bg(self, coro: coroutine, detached: bool=False) -> asyncio.Task:
+        """
+        Run coro in background, log errors.
+        The task is one of the client's live tasks, stopped when the connection
+        closes, unless it's `detached`
+        """
         async def runner():
             try:
                 await coro
+            except asyncio.CancelledError:
+                raise
             except:
                 self._log.exception("async: Coroutine raised exception")
-        return asyncio.ensure_future(runner())
+        if detached:
+            return asyncio.ensure_future(runner())
+        return self._tasks.spawn(runner())
+
+    def live_tasks(self) -> List[Tuple[asyncio.Task, float]]:
+        """
+        `(task, age in seconds)` of the client's background tasks, oldest first
+        """
+        return self._tasks.ages()
+
+    def _handler_runner(self, handler: Callable, blocking: Optional[bool]) -> Callable:
+        """
+        Coroutine function running `handler`, in a thread if it's blocking
+        """
+        if blocking is None:
+            blocking = not asyncio.iscoroutinefunction(handler)
+        if not blocking:
+            return handler
+
+        async def run(*args, **kwargs):
+            return await self.run_blocking(handler, *args, **kwargs)
+
+        return run
+
+    async def _with_timeout(self, awaitable, timeout: float, handler: Callable) -> Any:
+        """
+        Await `awaitable`, cancelling it after `timeout` seconds.
+        Timeouts are logged and counted, then re-raised.
+        """
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            self._count_timeout(handler, timeout)
+            raise
+
+    def _count_timeout(self, handler: Callable, timeout: float) -> None:
+        self._handler_timeouts += 1
+        self._log.warning("Handler %s timed out after %ss", handler, timeout)
+
+    async def run_blocking(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Call the blocking function `fn(*args, **kwargs)` in the thread pool of
+        blocking handlers and return its result. If that's awaitable, as for plain
+        wrappers of coroutine functions, it's awaited on the event loop.
+        """
+        result = await self._threads.run(fn, args, kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def run_in_process(self, fn: Callable, *args, timeout: float=None) -> Any:
+        """
+        Call `fn(*args)` in the process pool and return its result.
+        `fn`, the arguments and the result must be picklable.
+        :param timeout: seconds after which the call is abandoned with `asyncio.TimeoutError`
+        """
+        return await self._processes.run(fn, args, timeout)
+
+    async def _spawn_handler(self, target: Optional[str], record: Union[MessageHandler, JoinHandler],
+                             *args, **kwargs) -> None:
+        """
+        Run a user handler in the background, through `handler_pool` if there is one
+        :param target: channel or query the event belongs to, an ordered pool runs
+                       the handlers for one target in order
+        :param record: the handler's registration, with its runner and timeout
+        """
+        handler, run, timeout = record.handler, record.run, record.timeout
+        if timeout is None:
+            timeout = self.handler_timeout
+        if timeout:
+            run_unlimited = run
+
+            async def run(*args, **kwargs):
+                try:
+                    await self._with_timeout(run_unlimited(*args, **kwargs), timeout, handler)
+                except asyncio.TimeoutError:
+                    pass
+        if self.profiler is not None:
+            run = self.profiler.timed(handler, run)
+        if self.handler_pool is None:
+            self._bg(run(*args, **kwargs))
+        else:
+            await self.handler_pool.submit_to(target, run, *args, **kwargs)
 
     async def _handle_special(self, msg: IrcMessage) -> bool:
         if msg.args[0] == cc.PING:
@@ -462,11 +941,37 @@ class Client(metaclass=LoggerMetaClass):
             return True
         return False
 
-    async def _handle_on_message(self, message: Message) -> None:
-        for mh in self._on_message_handlers:
-            match = mh.matcher(message)
-            if match is not None:
-                self._bg(mh.handler(message, **match))
+    async def _handle_on_message(self, message: Message, handlers: bool=True) -> None:
+        channel = message.channel_name
+        sender = message.sender_name
+        if self._message_waiters:
+            self._message_waiters.resolve((
+                (MessageIndex.TEXT, message.text),
+                (MessageIndex.CHANNEL, channel),
+                (MessageIndex.SENDER, sender),
+                (None, None),
+            ), message)
+        if not handlers:
+            return
+        profiler = self.profiler
+        try:
+            for mh in self._on_message_handlers.candidates(message.text, channel, sender):
+                if profiler is None:
+                    match = mh.matcher(message)
+                else:
+                    match = None
+                    start = perf_counter()
+                    try:
+                        match = mh.matcher(message)
+                    finally:
+                        profiler.checked(mh.handler, perf_counter() - start, match is not None)
+                if match is not None:
+                    message._resolve()
+                    await self._spawn_handler(channel or sender, mh, message, **match)
+                    if mh.stop:
+                        break
+        except StopDispatch:
+            pass
 
     async def _connect(self) -> None:
         if self.password:
@@ -487,6 +992,16 @@ class Client(metaclass=LoggerMetaClass):
                 if feature == "PREFIX":  # PREFIX=(ov)@+
                     modes, _, prefixes = value[1:].partition(")")
                     self._prefix_map = dict(zip(prefixes, modes))
+                if feature == "TARGMAX":  # TARGMAX=PRIVMSG:4,NOTICE:4,JOIN:
+                    for limit in value.split(","):
+                        command, _, count = limit.partition(":")
+                        if not count:
+                            self._target_limits[command.upper()] = None
+                        elif count.isdigit():
+                            self._target_limits[command.upper()] = int(count)
+                        # ignore malformed limits rather than dropping the connection
+                if feature == "MAXTARGETS" and value.isdigit():  # MAXTARGETS=4
+                    self._max_targets = int(value)
 
         def await_motd():
             fut = asyncio.Future()
@@ -523,7 +1038,7 @@ class Client(metaclass=LoggerMetaClass):
             try:
                 await handler()
             except:
-                self._log.exception("Connect handler {} raised exception".format(handler))
+                self._log.exception("Connect handler %s raised exception", handler)
 
     def _resolve_sender(self, prefix: str) -> User:
         if "!" in prefix and "@" in prefix:
@@ -564,7 +1079,7 @@ class Client(metaclass=LoggerMetaClass):
                 self.remove_join_handler(waiter)
                 fut.set_result(channel_obj)
 
-        self._log.debug("Joining channel {}".format(channel))
+        self._log.debug("Joining channel %s", channel)
         await self._send(cc.JOIN, channel)
 
         if block:
@@ -575,8 +1090,9 @@ class Client(metaclass=LoggerMetaClass):
         user = self.get_user(msg.prefix)
         if user.name != self.nick:
             channel.users.add(user)
-            self._log.info("{} joined channel {}".format(user, channel))
+            self._log.info("%s joined channel %s", user, channel)
             return
+        self._relay_prefix = msg.prefix
         # TODO: make less ugly
         @self.on_command(cc.RPL_NAMREPLY, self.nick, "=", channel.name)
         @self.on_command(cc.RPL_NAMREPLY, self.nick, "*", channel.name)
@@ -595,11 +1111,11 @@ class Client(metaclass=LoggerMetaClass):
         async def join_finished(msg):
             self.remove_command_handler(gather_nicks)
             self.remove_command_handler(join_finished)
-            self._log.info("Joined channel {}".format(channel))
+            self._log.info("Joined channel %s", channel)
 
             for jh in self._on_join_handlers:
                 if not jh.channel or jh.channel == channel.name:
-                    self._bg(jh.handler(channel))
+                    await self._spawn_handler(channel.name, jh, channel)
 
     async def part(self, channel: str, reason: str=None, block: bool=None) -> None:
         if block:
@@ -609,6 +1125,8 @@ class Client(metaclass=LoggerMetaClass):
             await part_done
 
     async def quit(self, reason: str=None) -> Channel:
+        # the server closes the connection on QUIT, send what's queued first
+        await self._send_queue.wait_empty()
         await self._send(cc.QUIT, reason)
 
     def add_module(self, module: 'Module'):
@@ -620,13 +1138,13 @@ class Client(metaclass=LoggerMetaClass):
         for channel in self._channels.values():
             channel.users.discard(user)
         del self._users[user.name]
-        self._log.info("{} has quit: {}".format(user, msg.args[-1]))
+        self._log.info("%s has quit: %s", user, msg.args[-1])
 
     async def _on_part(self, msg: IrcMessage) -> None:
         user = self.get_user(msg.prefix)
         channel = self.get_channel(msg.args[1])
         channel.users.remove(user)
-        self._log.info("{} has left {}: {}".format(user, channel, msg.args[-1]))
+        self._log.info("%s has left %s: %s", user, channel, msg.args[-1])
 
     async def _on_nick(self, msg: IrcMessage) -> None:
         """
@@ -639,8 +1157,10 @@ class Client(metaclass=LoggerMetaClass):
         if old_nick == self.nick:
             # (Forced?) Nick change for ourself
             self.nick = user.name
+            if self._relay_prefix:
+                self._relay_prefix = "{}!{}".format(user.name, self._relay_prefix.partition("!")[2])
         self._users[user.name] = user
-        self._log.info("{} changed their nick from {} to {}".format(user, old_nick, user.name))
+        self._log.info("%s changed their nick from %s to %s", user, old_nick, user.name)
 
 
 class Module(metaclass=LoggerMetaClass):
@@ -657,7 +1177,7 @@ class Module(metaclass=LoggerMetaClass):
             """
             self._channel = channel
             for fn in self._buffered_calls:
-                self._log.debug("Executing buffered call {}".format(fn))
+                self._log.debug("Executing buffered call %s", fn)
                 fn()
 
         def _buffer_call(self, callable):
@@ -672,7 +1192,7 @@ class Module(metaclass=LoggerMetaClass):
 
                 def on_anything(*args, **kwargs):
                     def decorator(fn):
-                        self._log.debug("Cannot execute method {}(*{}, **{}) now, buffering".format(method, args, kwargs))
+                        self._log.debug("Cannot execute method %s(*%s, **%s) now, buffering", method, args, kwargs)
                         self._buffer_call(lambda: getattr(self._channel, method)(*args, **kwargs)(fn))
                         return fn
                     return decorator
@@ -694,7 +1214,7 @@ class Module(metaclass=LoggerMetaClass):
         """
         self.client = client
         for fn in self._buffered_calls:
-            self._log.debug("Executing buffered call {}".format(fn))
+            self._log.debug("Executing buffered call %s", fn)
             fn()
 
     def _buffer_call(self, callable):
@@ -704,7 +1224,7 @@ class Module(metaclass=LoggerMetaClass):
         if self.client:
             return self.client.get_channel(name)
 
-        self._log.debug("Cannot get channel {} now, returning proxy".format(name))
+        self._log.debug("Cannot get channel %s now, returning proxy", name)
         proxy = self.ChannelProxy(name, self)
         self._buffer_call(lambda: proxy._populate(self.client.get_channel(name)))
         return proxy
@@ -718,7 +1238,7 @@ class Module(metaclass=LoggerMetaClass):
 
         def on_anything(*args, **kwargs):
             def decorator(fn):
-                self._log.debug("Cannot execute method {}(*{}, **{}) now, buffering".format(method, args, kwargs))
+                self._log.debug("Cannot execute method %s(*%s, **%s) now, buffering", method, args, kwargs)
                 self._buffer_call(lambda: getattr(self.client, method)(*args, **kwargs)(fn))
                 return fn
             return decorator
@@ -1,14 +1,24 @@
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
 import textwrap
 import shlex
 import inspect
 from typing import Sequence
-from asif.bot import Channel, User
 
 class _Command:
-    def __init__(self, name: str, hint: str, fn):
+    def __init__(self, name: str, hint: str, fn, blocking: bool=None,
+                 process: bool=False, timeout: float=None):
         self.name = name
         self.hint = hint
         self._fn = fn
+        if process and asyncio.iscoroutinefunction(fn):
+            raise ValueError("process command {} must be a plain function, "
+                             "coroutines can't run in a worker process".format(name))
+        if blocking is None:
+            blocking = not asyncio.iscoroutinefunction(fn)
+        self.blocking = blocking
+        self.process = process
+        self.timeout = timeout
         self._spec = inspect.getfullargspec(fn)
         if fn.__doc__:
             self.doc = fn.__doc__.lstrip("\n").rstrip("\n ")
@@ -38,7 +48,8 @@ class CommandSet:
         self._commands = dict()
         self._aliases = dict()
 
-        client.on_message()(self._dispatch)
+        # commands have their own timeouts
+        client.on_message(timeout=0)(self._dispatch)
 
         self.command("help")(self._help)
 
@@ -53,7 +64,7 @@ class CommandSet:
                 for key, cmd in self._commands.items() if key not in ("bots", "help"))
             lines = textwrap.wrap("; ".join(docs), width=400)
             for line in lines:
-                if isinstance(message.recipient, Channel):
+                if message.channel_name is not None:
                     await message.sender.message(line, notice=True)
                 else:
                     await message.sender.message(line)
@@ -82,7 +93,7 @@ class CommandSet:
         elif args[0][0] == self.prefix:
             _cmd = args[0][1:]
             args = args[1:]
-        elif isinstance(message.recipient, User):
+        elif message.channel_name is None:
             _cmd = args[0]
             args = args[1:]
         else:
@@ -90,16 +101,42 @@ class CommandSet:
         cmd = self._commands.get(_cmd)
         if not cmd:
             return
-        reply = await cmd(*args,
-            message=message,
-            client=self.client,
-            cmdset=self)
+        timeout = cmd.timeout if cmd.timeout is not None else self.client.handler_timeout
+        if cmd.process:
+            try:
+                reply = await self.client.run_in_process(cmd._fn, *args, timeout=timeout or None)
+            except asyncio.TimeoutError:
+                self.client._count_timeout(cmd._fn, timeout)
+                return
+            except BrokenProcessPool:
+                # e.g. another command timed out and took the pool down with it,
+                # counted and logged by the pool
+                return
+        else:
+            if cmd.blocking:
+                call = self.client.run_blocking(cmd, *args,
+                    message=message,
+                    client=self.client,
+                    cmdset=self)
+            else:
+                call = cmd(*args,
+                    message=message,
+                    client=self.client,
+                    cmdset=self)
+            if not timeout:
+                reply = await call
+            else:
+                try:
+                    reply = await self.client._with_timeout(call, timeout, cmd._fn)
+                except asyncio.TimeoutError:
+                    return
         if isinstance(reply, str):
-            if isinstance(message.recipient, Channel):
-                reply = f"{message.sender.name}: {reply}"
+            if message.channel_name is not None:
+                reply = f"{message.sender_name}: {reply}"
             await message.reply(reply)
 
-    def command(self, name: str=None, hint: str=None, aliases: Sequence[str]=list()):
+    def command(self, name: str=None, hint: str=None, aliases: Sequence[str]=list(),
+                blocking: bool=None, process: bool=False, timeout: float=None):
         """
         Register a command handler that will be invoked when a command is
         detected. If your handler has a docstring, it will be shown for
@@ -114,13 +151,29 @@ class CommandSet:
         If your function returns a string, it will be given back to the user
         who issued the command.
 
+        Plain (non-async) functions are run in the client's thread pool, so they
+        may block; they shouldn't touch the client other than through their
+        return value.
+
+        With process=True the command runs in the client's process pool, for
+        CPU-heavy work. It only gets the *args and must be a plain function
+        defined at module level, as it and its return value are pickled.
+
         :param name: name of the command. Defaults to __name__ if None.
         :param hint: hint for the command (shown for .help).
         :param aliases: aliases for this command.
+        :param blocking: run the command in a thread, defaults to whether fn is
+            not a coroutine function.
+        :param process: run the command in a worker process, `fn` must not be
+            a coroutine function.
+        :param timeout: seconds after which the command is cancelled without
+            reply, defaults to the client's handler_timeout, 0 for no limit.
+            Workers of process commands are terminated, blocking commands
+            can't be stopped and keep their thread until they return.
         """
         def decorator(fn):
             _name = name or fn.__name__
-            cmd = _Command(_name, hint, fn)
+            cmd = _Command(_name, hint, fn, blocking, process, timeout)
             self._commands[_name] = cmd
             for alias in aliases:
                 self._aliases[alias] = cmd
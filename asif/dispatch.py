@@ -0,0 +1,519 @@
+import asyncio
+import heapq
+import itertools
+from operator import attrgetter
+import re
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+
+def required_literals(pattern) -> Optional[Tuple[str, ...]]:
+    """
+    Literal strings of which at least one occurs in every text `pattern` matches,
+    or `None` if no such set can be derived (e.g. case-insensitive patterns).
+    Checking them with `in` is a plain substring scan, much cheaper than running
+    a regex that doesn't start with a literal, such as `(?P<nick>\\w+)\\+\\+`.
+    """
+    if not isinstance(pattern.pattern, str) or pattern.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    literals = _required_literals(parsed)
+    return tuple(literals) if literals else None
+
+
+def literal_prefix(pattern) -> Optional[str]:
+    """
+    Literal text every match of an anchored `pattern` (`^!ping`, `\\A!join`)
+    starts with, or `None` if there is none or the pattern isn't anchored to the
+    start of the text.
+    """
+    if not isinstance(pattern.pattern, str) or pattern.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    if not len(parsed):
+        return None
+    op, av = parsed[0]
+    if op is not sre_parse.AT:
+        return None
+    if not (av is sre_parse.AT_BEGINNING_STRING
+            or (av is sre_parse.AT_BEGINNING and not pattern.flags & re.MULTILINE)):
+        return None
+    prefix = []
+    _literal_prefix(list(parsed)[1:], prefix)
+    return "".join(prefix) or None
+
+
+def _literal_prefix(items, prefix: List[str]) -> bool:
+    """
+    Append the leading literals of `items` to `prefix`, descending into groups.
+    Returns whether all of `items` were literals.
+    """
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            prefix.append(chr(av))
+        elif op is sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+            if not _literal_prefix(av[-1], prefix):
+                return False
+        else:
+            return False
+    return True
+
+
+class PrefixTrie:
+    """
+    Character trie of literal prefixes, finds the entries of all prefixes of a
+    text in a single walk over its beginning
+    """
+
+    def __init__(self):
+        # node: [children, entries]
+        self._root = [{}, HandlerList()]
+
+    def entries(self, prefix: str) -> 'HandlerList':
+        """
+        The `HandlerList` of `prefix`, creating the nodes on its path if needed
+        """
+        node = self._root
+        for char in prefix:
+            child = node[0].get(char)
+            if child is None:
+                child = node[0][char] = [{}, HandlerList()]
+            node = child
+        return node[1]
+
+    def get(self, prefix: str) -> Optional['HandlerList']:
+        """
+        The `HandlerList` of `prefix`, `None` if there's no node for it
+        """
+        node = self._root
+        for char in prefix:
+            node = node[0].get(char)
+            if node is None:
+                return None
+        return node[1]
+
+    def __delitem__(self, prefix: str) -> None:
+        """
+        Drop the entries of `prefix` and prune the nodes left without entries
+        or children on its path, so add/remove cycles don't leak nodes
+        """
+        node = self._root
+        path = []
+        for char in prefix:
+            child = node[0].get(char)
+            if child is None:
+                raise KeyError(prefix)
+            path.append((node[0], char))
+            node = child
+        node[1] = HandlerList()
+        for children, char in reversed(path):
+            child = children[char]
+            if child[0] or child[1]:
+                break
+            del children[char]
+
+    def matches(self, text: str) -> list:
+        """
+        Entries of all prefixes `text` starts with, shortest prefix first
+        """
+        found = []
+        children = self._root[0]
+        for char in text:
+            node = children.get(char)
+            if node is None:
+                break
+            children, entries = node
+            if entries:
+                found.extend(entries.snapshot())
+        return found
+
+    def __iter__(self) -> Iterator:
+        stack = [self._root]
+        while stack:
+            children, entries = stack.pop()
+            yield from entries.snapshot()
+            stack.extend(children.values())
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def _required_literals(subpattern) -> Optional[List[str]]:
+    best = None
+
+    def better(candidate):
+        # prefer the alternatives whose shortest literal is longest
+        if not candidate:
+            return best
+        if best is None or min(map(len, candidate)) > min(map(len, best)):
+            return candidate
+        return best
+
+    run = []
+    for op, av in subpattern:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            best = better(["".join(run)])
+            run = []
+        if op is sre_parse.SUBPATTERN:
+            # (group, add_flags, del_flags, pattern)
+            if not av[1] & re.IGNORECASE:
+                best = better(_required_literals(av[-1]))
+        elif op is sre_parse.BRANCH:
+            alternatives = [_required_literals(branch) for branch in av[1]]
+            if all(alternatives):
+                best = better([lit for alternative in alternatives for lit in alternative])
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            best = better(_required_literals(av[2]))
+    if run:
+        best = better(["".join(run)])
+    return best
+
+
+class StopDispatch(Exception):
+    """
+    Raise in a message matcher or command handler to stop the dispatch of the
+    current line: handlers that come after it are skipped
+    """
+
+
+class Registration:
+    """
+    Handle of a registered handler, as returned by `Client.add_message_handler` and
+    friends. `remove` unregisters it in O(1), also while handlers are being dispatched.
+    """
+
+    __slots__ = ("record", "seq", "rank", "removed", "literals", "prefix", "_index", "_list", "_key")
+
+    def __init__(self, record, seq: int, index: 'HandlerIndex', priority: int=0):
+        self.record = record
+        self.seq = seq
+        # dispatch order: higher priority first, then registration order
+        self.rank = (-priority, seq)
+        self.removed = False
+        self.literals = None
+        self.prefix = None
+        self._index = index
+        self._list = None
+        self._key = None
+
+    @property
+    def handler(self) -> Callable:
+        return self.record.handler
+
+    def remove(self) -> None:
+        if self.removed:
+            return
+        self.removed = True
+        self._index._discard(self)
+
+    def __repr__(self):
+        return "<Registration {}{}>".format(self.record, " (removed)" if self.removed else "")
+
+
+class HandlerList:
+    """
+    Collection of registrations with O(1) removal, iterated in dispatch order.
+    Iteration goes through a snapshot that's only rebuilt after a change, so
+    the list may be changed while it's being iterated.
+    """
+
+    __slots__ = ("_entries", "_snapshot")
+
+    def __init__(self):
+        self._entries = {}
+        self._snapshot = ()
+
+    def add(self, entry) -> None:
+        self._entries[entry] = None
+        self._snapshot = None
+
+    def discard(self, entry) -> None:
+        if self._entries.pop(entry, self) is not self:
+            self._snapshot = None
+
+    def snapshot(self) -> tuple:
+        """
+        Entries in dispatch order (see `Registration.rank`)
+        """
+        if self._snapshot is None:
+            self._snapshot = tuple(sorted(self._entries, key=_rank_key))
+        return self._snapshot
+
+    def __iter__(self) -> Iterator:
+        return iter(self.snapshot())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_rank_key = attrgetter("rank")
+
+
+class HandlerIndex:
+    """
+    Registered handler records in dispatch order.
+    Base of the indexed collections, also used as is for join handlers.
+    """
+
+    def __init__(self):
+        self._all = HandlerList()
+        self._by_handler = {}
+        self._seq = itertools.count()
+
+    def add(self, record, priority: int=0) -> Registration:
+        reg = self._register(record, priority)
+        self._place(reg, self._all, None, None)
+        return reg
+
+    def _register(self, record, priority: int=0) -> Registration:
+        reg = Registration(record, next(self._seq), self, priority)
+        self._by_handler.setdefault(record.handler, {})[reg] = None
+        return reg
+
+    @staticmethod
+    def _place(reg: Registration, entries: HandlerList, owner, key) -> None:
+        """
+        Put `reg` into `entries`, which is `owner[key]` if `owner` is given.
+        `owner` is a dict or a `PrefixTrie`, its empty lists are deleted on removal.
+        """
+        entries.add(reg)
+        reg._list = entries
+        if owner is not None:
+            reg._key = (owner, key)
+
+    def _discard(self, reg: Registration) -> None:
+        reg._list.discard(reg)
+        if reg._key is not None and not reg._list:
+            owner, key = reg._key
+            if owner.get(key) is reg._list:
+                del owner[key]
+        regs = self._by_handler.get(reg.record.handler)
+        if regs is not None:
+            regs.pop(reg, None)
+            if not regs:
+                del self._by_handler[reg.record.handler]
+
+    def remove(self, handler) -> list:
+        """
+        Remove all registrations of `handler`, returns the removed records
+        """
+        regs = list(self._by_handler.get(handler, ()))
+        for reg in regs:
+            reg.remove()
+        return [reg.record for reg in regs]
+
+    def __iter__(self) -> Iterator:
+        return (reg.record for reg in self._all if not reg.removed)
+
+    def __len__(self) -> int:
+        return sum(len(regs) for regs in self._by_handler.values())
+
+
+class MessageIndex(HandlerIndex):
+    """
+    Message handler collection bucketed by the exact-match filter a handler was
+    registered with (message text, channel name or sender name).
+    Handlers without such a filter (regex or custom matchers only) end up in a
+    residual list that is checked for every message.
+    Handlers with a message regex (`MessageHandler.regex`, searched by the
+    handler's matcher) are skipped here if the text lacks its `required_literals`.
+    Residual handlers with an anchored regex are kept in a `PrefixTrie` by its
+    `literal_prefix` instead, so messages not starting with it skip them without
+    any per-handler work.
+    """
+
+    TEXT = "text"
+    CHANNEL = "channel"
+    SENDER = "sender"
+
+    def __init__(self):
+        super().__init__()
+        self._buckets = {self.TEXT: {}, self.CHANNEL: {}, self.SENDER: {}}
+        self._residual = HandlerList()
+        self._prefixes = PrefixTrie()
+
+    def add(self, mh, bucket: Optional[str]=None, key: str=None, priority: int=0) -> Registration:
+        """
+        Add message handler `mh`, indexed under `key` in `bucket` or into the
+        residual list if no bucket is given.
+        """
+        reg = self._register(mh, priority)
+        if mh.regex is not None:
+            reg.prefix = literal_prefix(mh.regex)
+            if reg.prefix is None:
+                reg.literals = required_literals(mh.regex)
+        if bucket is not None:
+            owner = self._buckets[bucket]
+            entries = owner.get(key)
+            if entries is None:
+                entries = owner[key] = HandlerList()
+            self._place(reg, entries, owner, key)
+        elif reg.prefix is not None:
+            entries = self._prefixes.entries(reg.prefix)
+            self._place(reg, entries, self._prefixes, reg.prefix)
+        else:
+            self._place(reg, self._residual, None, None)
+        return reg
+
+    def candidates(self, text: str, channel: Optional[str], sender: Optional[str]) -> Iterator:
+        """
+        Yield the handlers that could match a message with the given text, channel
+        name (`None` for queries) and sender nick (`None` for server messages) in
+        dispatch order. Handlers removed during the iteration are skipped.
+        """
+        lists = [self._residual.snapshot()]
+        entries = self._prefixes.matches(text)
+        if entries:
+            entries.sort(key=_rank_key)
+            lists.append(entries)
+        entries = self._buckets[self.TEXT].get(text)
+        if entries:
+            lists.append(entries.snapshot())
+        if channel is not None:
+            entries = self._buckets[self.CHANNEL].get(channel)
+            if entries:
+                lists.append(entries.snapshot())
+        if sender is not None:
+            entries = self._buckets[self.SENDER].get(sender)
+            if entries:
+                lists.append(entries.snapshot())
+        regs = lists[0] if len(lists) == 1 else heapq.merge(*lists, key=_rank_key)
+        for reg in regs:
+            if reg.removed:
+                continue
+            prefix = reg.prefix
+            if prefix is not None and not text.startswith(prefix):
+                continue
+            literals = reg.literals
+            if literals is not None and not any(literal in text for literal in literals):
+                continue
+            yield reg.record
+
+    def __iter__(self) -> Iterator:
+        lists = [self._residual.snapshot(), sorted(self._prefixes, key=_rank_key)]
+        for bucket in self._buckets.values():
+            lists.extend(entries.snapshot() for entries in bucket.values())
+        return (reg.record for reg in heapq.merge(*lists, key=_rank_key))
+
+
+class CommandIndex(HandlerIndex):
+    """
+    Command handler table keyed on the verb (first arg) a handler was registered with.
+    Only handlers registered for the verb of an incoming line (plus the rare ones
+    registered without any args) have their remaining args compared.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._by_verb = {}
+        self._wildcard = HandlerList()
+
+    def add(self, ch, priority: int=0) -> Registration:
+        reg = self._register(ch, priority)
+        if ch.args:
+            entries = self._by_verb.get(ch.args[0])
+            if entries is None:
+                entries = self._by_verb[ch.args[0]] = HandlerList()
+            self._place(reg, entries, self._by_verb, ch.args[0])
+        else:
+            self._place(reg, self._wildcard, None, None)
+        return reg
+
+    def matching(self, args: Sequence[str]) -> Iterator:
+        """
+        Yield handlers whose args match the beginning of `args` in dispatch order.
+        Handlers removed during the iteration are skipped.
+        """
+        entries = self._by_verb.get(args[0])
+        regs = entries.snapshot() if entries else ()
+        if self._wildcard:
+            regs = heapq.merge(regs, self._wildcard.snapshot(), key=_rank_key)
+        for reg in regs:
+            if reg.removed:
+                continue
+            ch = reg.record
+            hargs = ch.args
+            if len(hargs) <= 1 or hargs[1:] == tuple(args[1:len(hargs)]):
+                yield ch
+
+    def __iter__(self) -> Iterator:
+        lists = [self._wildcard.snapshot(), *(entries.snapshot() for entries in self._by_verb.values())]
+        return (reg.record for reg in heapq.merge(*lists, key=_rank_key))
+
+
+class WaiterTable:
+    """
+    One-shot waiters: futures resolved with the first value their predicate
+    accepts, or with the first value at all if they have none. Waiters are keyed
+    so only those registered under one of the keys of a value are tested. They
+    are removed as soon as their future is done, whether resolved, timed out or
+    cancelled.
+    """
+
+    def __init__(self):
+        self._waiters = {}
+
+    def add(self, key, predicate: Optional[Callable[[Any], bool]], timeout: float=None) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        waiters = self._waiters.get(key)
+        if waiters is None:
+            waiters = self._waiters[key] = {}
+        waiters[fut] = predicate
+
+        timer = None
+        if timeout is not None:
+            def expire():
+                if not fut.done():
+                    fut.set_exception(asyncio.TimeoutError())
+            timer = loop.call_later(timeout, expire)
+
+        def done(_):
+            if timer is not None:
+                timer.cancel()
+            waiters.pop(fut, None)
+            if not waiters and self._waiters.get(key) is waiters:
+                del self._waiters[key]
+
+        fut.add_done_callback(done)
+        return fut
+
+    def resolve(self, keys: Iterable, value) -> None:
+        """
+        Resolve the waiters under any of `keys` whose predicate accepts `value`
+        """
+        for key in keys:
+            waiters = self._waiters.get(key)
+            if not waiters:
+                continue
+            for fut, predicate in list(waiters.items()):
+                if fut.done():
+                    continue
+                if predicate is None:
+                    fut.set_result(value)
+                    continue
+                try:
+                    if predicate(value):
+                        fut.set_result(value)
+                except Exception as e:
+                    fut.set_exception(e)
+
+    def __bool__(self) -> bool:
+        # keys are dropped with their last waiter, checked for every received line
+        return bool(self._waiters)
+
+    def __len__(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
@@ -0,0 +1,501 @@
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import itertools
+import logging
+import os
+import stat
+import time
+from typing import Any, Callable, Hashable, List, Tuple
+
+# What `HandlerPool.submit` does when the queue is full
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+
+
+class TaskRegistry:
+    """
+    Live tasks with their start times. Tasks leave the registry when they're done.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self._tasks[task] = time.monotonic()
+        task.add_done_callback(self._tasks.pop)
+        return task
+
+    def ages(self) -> List[Tuple[asyncio.Task, float]]:
+        """
+        `(task, seconds since it was started)` for every live task, oldest first
+        """
+        now = time.monotonic()
+        return [(task, now - started) for task, started in self._tasks.items()]
+
+    def stats(self) -> dict:
+        oldest = next(iter(self._tasks.values()), None)
+        return {
+            "count": len(self._tasks),
+            "oldest_age": time.monotonic() - oldest if oldest is not None else 0.0,
+        }
+
+    async def close(self, timeout: float=0) -> int:
+        """
+        Give the live tasks `timeout` seconds to finish, then cancel the rest and
+        wait for them to unwind. Returns the number of cancelled tasks.
+        """
+        tasks = list(self._tasks)
+        if tasks and timeout:
+            await asyncio.wait(tasks, timeout=timeout)
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        return len(pending)
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+
+class HandlerPool:
+    """
+    Runs handler coroutines with at most `max_workers` of them in flight.
+    Calls submitted while all workers are busy wait in a FIFO of `queue_size`
+    entries; once that is full the `overflow` policy decides: "block" makes
+    `submit` wait for room (which stalls the reader and with it the
+    connection), "drop_newest" discards the submitted call and "drop_oldest"
+    discards the longest waiting one.
+    Calls are queued as function and arguments, the coroutine is only created
+    when a worker picks it up, so dropped calls leave nothing behind.
+    An `ordered` pool keeps calls for one target (see `submit_to`) in order.
+    Its tasks are kept in `registry` if set; the client sets its own registry
+    when given a pool without one.
+    """
+
+    _log = logging.getLogger("bot.HandlerPool")
+
+    def __init__(self, max_workers: int=64, queue_size: int=1024, overflow: str=OVERFLOW_BLOCK,
+                 ordered: bool=False, registry: TaskRegistry=None):
+        """
+        :param max_workers: maximum number of handlers running at once
+        :param queue_size: maximum number of calls waiting for a worker, 0 for no limit
+        :param overflow: "block", "drop_newest" or "drop_oldest"
+        :param ordered: run calls submitted for the same target with `submit_to`
+                        one after another in submission order
+        :param registry: `TaskRegistry` to spawn the handler tasks in
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers must be positive, got {}".format(max_workers))
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST):
+            raise ValueError("Unknown overflow={}".format(overflow))
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.ordered = ordered
+        self.registry = registry
+        # waiting calls are kept as `(seq, call)`, `seq` orders them across queues
+        self._seq = itertools.count()
+        # calls without a target waiting for a worker
+        self._queue = deque()
+        # calls with a target not started yet per target, a target has a lane while
+        # it has a call running or waiting and is forgotten as soon as it goes idle
+        self._lanes = {}
+        # targets whose next call can start once a worker is free, in FIFO order
+        self._ready = OrderedDict()
+        # `(seq, target)` of the calls in the lanes in submission order, for
+        # "drop_oldest"; entries of calls that left their lane are skipped lazily
+        self._order = deque()
+        # running task -> target, `None` for calls without one
+        self._tasks = {}
+        self._pending = 0
+        self._putters = deque()
+
+        self.submitted = 0
+        self.queued = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+
+    def full(self) -> bool:
+        return 0 < self.queue_size <= self._pending
+
+    async def submit(self, fn: Callable, *args, **kwargs) -> bool:
+        """
+        Run `fn(*args, **kwargs)` on a worker as soon as one is free.
+        Returns `False` if the call was dropped.
+        """
+        return await self._submit(None, fn, args, kwargs)
+
+    async def submit_to(self, target: Hashable, fn: Callable, *args, **kwargs) -> bool:
+        """
+        Like `submit`, but if the pool is `ordered` calls for the same `target`
+        (e.g. a channel name) never run concurrently and start in submission
+        order, while calls for different targets run in parallel.
+        """
+        return await self._submit(target if self.ordered else None, fn, args, kwargs)
+
+    async def _submit(self, target: Hashable, fn: Callable, args: tuple, kwargs: dict) -> bool:
+        self.submitted += 1
+        call = (fn, args, kwargs)
+        while True:
+            if not self._queue and not self._ready and len(self._tasks) < self.max_workers \
+                    and target not in self._lanes:
+                if target is not None:
+                    self._lanes[target] = deque()
+                self._start(target, call)
+                return True
+            if not self.full():
+                break
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self._drop(fn)
+                return False
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                self._drop_oldest()
+                break
+            putter = asyncio.get_event_loop().create_future()
+            self._putters.append(putter)
+            try:
+                await putter
+            except:
+                putter.cancel()
+                if not self.full():
+                    self._wakeup_putter()
+                raise
+        seq = next(self._seq)
+        if target is None:
+            self._queue.append((seq, call))
+        else:
+            lane = self._lanes.get(target)
+            if lane is None:
+                lane = self._lanes[target] = deque()
+                self._ready[target] = None
+            lane.append((seq, call))
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                self._track_order(seq, target)
+        self._pending += 1
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._pending)
+        return True
+
+    def stats(self) -> dict:
+        """
+        Counters since creation plus the current number of running and waiting calls
+        """
+        return {
+            "in_flight": len(self._tasks),
+            "queue_depth": self._pending,
+            "targets": len(self._lanes),
+            "max_queue_depth": self.max_queue_depth,
+            "submitted": self.submitted,
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    def _drop(self, fn: Callable) -> None:
+        self.dropped += 1
+        self._log.debug("Queue full, dropping call of handler %s", fn)
+
+    def _in_lane(self, seq: int, target: Hashable) -> bool:
+        # lanes are FIFOs of increasing `seq` and a target's next lane only gets
+        # later calls, so a call is still waiting iff it's not before the head
+        lane = self._lanes.get(target)
+        return bool(lane) and lane[0][0] <= seq
+
+    def _track_order(self, seq: int, target: Hashable) -> None:
+        order = self._order
+        order.append((seq, target))
+        if len(order) > 2 * self._pending + 64:
+            # mostly started calls, compact (amortized O(1) per call)
+            self._order = deque(entry for entry in order if self._in_lane(*entry))
+
+    def _drop_oldest(self) -> None:
+        order = self._order
+        while order and not self._in_lane(*order[0]):
+            order.popleft()
+        queue = self._queue
+        if order and (not queue or order[0][0] < queue[0][0]):
+            target = order.popleft()[1]
+            lane = self._lanes[target]
+            fn = lane.popleft()[1][0]
+            if not lane and target in self._ready:
+                # a ready target has no running call either
+                del self._ready[target]
+                del self._lanes[target]
+        else:
+            fn = queue.popleft()[1][0]
+        self._pending -= 1
+        self._drop(fn)
+
+    def clear(self) -> int:
+        """
+        Drop all calls waiting for a worker, returns their number
+        """
+        dropped = self._pending
+        self._queue.clear()
+        self._lanes = {target: deque() for target in self._tasks.values() if target is not None}
+        self._ready.clear()
+        self._order.clear()
+        self._pending = 0
+        self.dropped += dropped
+        while self._putters:
+            self._wakeup_putter()
+        return dropped
+
+    def _start(self, target: Hashable, call: tuple) -> None:
+        spawn = self.registry.spawn if self.registry is not None else asyncio.ensure_future
+        task = spawn(self._run(*call))
+        self._tasks[task] = target
+        task.add_done_callback(self._done)
+
+    async def _run(self, fn: Callable, args: tuple, kwargs: dict) -> None:
+        try:
+            await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.failed += 1
+            self._log.exception("async: Handler %s raised exception", fn)
+        else:
+            self.completed += 1
+
+    def _done(self, task: asyncio.Task) -> None:
+        target = self._tasks.pop(task)
+        if target is not None:
+            if self._lanes[target]:
+                self._ready[target] = None
+            else:
+                del self._lanes[target]
+        queue, ready = self._queue, self._ready
+        while (queue or ready) and len(self._tasks) < self.max_workers:
+            # the older of the next call without a target and the next ready one
+            if ready:
+                target = next(iter(ready))
+                lane = self._lanes[target]
+            if ready and (not queue or lane[0][0] < queue[0][0]):
+                del ready[target]
+                call = lane.popleft()[1]
+            else:
+                target = None
+                call = queue.popleft()[1]
+            self._pending -= 1
+            self._start(target, call)
+            self._wakeup_putter()
+
+    def _wakeup_putter(self) -> None:
+        putters = self._putters
+        while putters:
+            putter = putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+                return
+
+    def __repr__(self):
+        return "<HandlerPool max_workers={self.max_workers} queue_size={self.queue_size} " \
+               "overflow={self.overflow} ordered={self.ordered}>".format(self=self)
+
+
+class ThreadOffload:
+    """
+    Runs blocking (non-coroutine) handlers on a `ThreadPoolExecutor` so they
+    don't stall the event loop, counting how often callers had to wait because
+    every thread was busy. The executor is created on first use.
+    """
+
+    def __init__(self, max_workers: int=4):
+        """
+        :param max_workers: number of threads
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers must be positive, got {}".format(max_workers))
+        self.max_workers = max_workers
+        self._executor = None
+        self._in_flight = 0
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.saturated = 0
+        self.max_in_flight = 0
+
+    async def run(self, fn: Callable, args: tuple=(), kwargs: dict=None) -> Any:
+        """
+        Call `fn(*args, **kwargs)` in a thread and return its result
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="asif-blocking")
+        if self._in_flight >= self.max_workers:
+            self.saturated += 1
+        self.submitted += 1
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        loop = asyncio.get_event_loop()
+        future = self._executor.submit(partial(fn, *args, **(kwargs or {})))
+        # count in the loop thread, the thread keeps running if the caller is cancelled
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._finished, f))
+        return await asyncio.wrap_future(future)
+
+    def _finished(self, future: Future) -> None:
+        self._in_flight -= 1
+        if future.cancelled() or future.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
+
+    def stats(self) -> dict:
+        """
+        Counters since creation, `saturated` is the number of calls that found
+        every thread busy, `waiting` the number of calls currently queued for one
+        """
+        return {
+            "max_workers": self.max_workers,
+            "in_flight": self._in_flight,
+            "waiting": max(0, self._in_flight - self.max_workers),
+            "max_in_flight": self.max_in_flight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "saturated": self.saturated,
+        }
+
+    def shutdown(self, wait: bool=True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait)
+            self._executor = None
+
+    def __repr__(self):
+        return "<ThreadOffload max_workers={self.max_workers}>".format(self=self)
+
+
+def _close_inherited_sockets() -> None:
+    """
+    Process pool initializer: forked workers inherit the client's connection,
+    which would keep it from closing when the client closes its end
+    """
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return
+    for fd in map(int, fds):
+        try:
+            if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                os.close(fd)
+        except OSError:
+            pass
+
+
+class ProcessOffload:
+    """
+    Runs CPU-heavy functions in a `ProcessPoolExecutor`. Functions, arguments
+    and results are pickled, so functions must be defined at module level.
+    The pool is recycled, i.e. replaced by a fresh one while the old workers
+    finish their calls and exit, every `recycle_after` calls. A call that times
+    out can't be interrupted, so the pool is torn down at once and its workers
+    are terminated; other calls running in it fail as well, with `BrokenProcessPool`.
+    """
+
+    _log = logging.getLogger("bot.ProcessOffload")
+
+    def __init__(self, max_workers: int=2, recycle_after: int=1000):
+        """
+        :param max_workers: number of worker processes
+        :param recycle_after: replace the pool after this many calls, 0 to never do so
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers must be positive, got {}".format(max_workers))
+        self.max_workers = max_workers
+        self.recycle_after = recycle_after
+        self._executor = None
+        self._calls = 0
+        self._in_flight = 0
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.broken = 0
+        self.recycled = 0
+
+    async def run(self, fn: Callable, args: tuple=(), timeout: float=None) -> Any:
+        """
+        Call `fn(*args)` in a worker process and return its result
+        :param timeout: seconds after which the call is abandoned with `asyncio.TimeoutError`
+        """
+        if self._executor is None:
+            try:
+                self._executor = ProcessPoolExecutor(self.max_workers, initializer=_close_inherited_sockets)
+            except TypeError:  # Python < 3.7
+                self._executor = ProcessPoolExecutor(self.max_workers)
+            self._calls = 0
+        executor = self._executor
+        future = executor.submit(fn, *args)
+        # there's no public way to stop a busy worker, and `shutdown` forgets them
+        processes = getattr(executor, "_processes", None) or {}
+        self._calls += 1
+        self.submitted += 1
+        self._in_flight += 1
+        if self.recycle_after and self._calls >= self.recycle_after:
+            self._recycle()
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._log.warning("Call of %s timed out after %ss, terminating its pool", fn, timeout)
+            self._recycle(executor)
+            for process in list(processes.values()):
+                process.terminate()
+            raise
+        except BrokenProcessPool:
+            self.broken += 1
+            self._log.warning("Call of %s failed, its pool was terminated", fn)
+            # replace the pool if a worker died on its own
+            self._recycle(executor)
+            raise
+        except:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+            return result
+        finally:
+            self._in_flight -= 1
+
+    def _recycle(self, executor: ProcessPoolExecutor=None) -> None:
+        """
+        Stop handing calls to `executor` (the current one by default)
+        """
+        if executor is None:
+            executor = self._executor
+        if executor is self._executor:
+            self._executor = None
+            self.recycled += 1
+        executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "in_flight": self._in_flight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "broken": self.broken,
+            "recycled": self.recycled,
+        }
+
+    def shutdown(self, wait: bool=True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait)
+            self._executor = None
+
+    def __repr__(self):
+        return "<ProcessOffload max_workers={self.max_workers} recycle_after={self.recycle_after}>" \
+            .format(self=self)
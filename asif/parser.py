@@ -0,0 +1,36 @@
+from collections import namedtuple
+from typing import Optional
+
+IrcMessage = namedtuple("IrcMessage", ("prefix", "args"))
+
+
+def parse_message(line: str) -> Optional[IrcMessage]:
+    """
+    Parse a decoded IRC line into an `IrcMessage`, trailing CR/LF is ignored.
+    Splits in a single pass: one partition each for the prefix and the trailing
+    param, one split for the middle params.
+    Returns `None` for empty or prefix-only lines.
+    """
+    # adopted from twisted/words/protocols/irc.py
+    line = line.rstrip("\r\n")
+    if not line:
+        return None
+    prefix = None
+    if line[0] == ":":
+        prefix, _, line = line[1:].partition(" ")
+    head, sep, trailing = line.partition(" :")
+    args = head.split()
+    if sep:
+        args.append(trailing)
+    if not args:
+        return None
+    return IrcMessage(prefix, tuple(args))
+
+
+def parse_line(line: bytes, encoding: str="utf-8") -> Optional[IrcMessage]:
+    """
+    Parse a raw IRC line as received from the server, see `parse_message`.
+    The line is decoded in one go: decoding params separately or on access
+    costs more in Python-level bookkeeping than it saves.
+    """
+    return parse_message(line.decode(encoding))
@@ -0,0 +1,159 @@
+import asyncio
+from bisect import bisect_left
+import logging
+from time import perf_counter
+from typing import Callable, List
+
+
+class Histogram:
+    """
+    Counts of durations per bucket, `bounds` are the buckets' upper bounds in
+    seconds, durations above the last bound go into an overflow bucket
+    """
+
+    __slots__ = ("bounds", "counts")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, seconds: float) -> None:
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+
+    def snapshot(self) -> dict:
+        labels = ["<={}s".format(bound) for bound in self.bounds] + [">{}s".format(self.bounds[-1])]
+        return dict(zip(labels, self.counts))
+
+
+class HandlerStats:
+    """
+    Counters of one handler, see `HandlerProfiler.snapshot`
+    """
+
+    __slots__ = ("handler", "checks", "matches", "match_time", "match_histogram",
+                 "runs", "run_time", "run_histogram", "errors", "cancelled")
+
+    MATCH_BOUNDS = (1e-6, 1e-5, 1e-4, 1e-3)
+    RUN_BOUNDS = (0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self, handler: Callable):
+        self.handler = handler
+        self.checks = 0
+        self.matches = 0
+        self.match_time = 0.0
+        self.match_histogram = Histogram(self.MATCH_BOUNDS)
+        self.runs = 0
+        self.run_time = 0.0
+        self.run_histogram = Histogram(self.RUN_BOUNDS)
+        self.errors = 0
+        self.cancelled = 0
+
+    @property
+    def name(self) -> str:
+        handler = self.handler
+        return "{}.{}".format(getattr(handler, "__module__", None),
+                              getattr(handler, "__qualname__", repr(handler)))
+
+    def snapshot(self) -> dict:
+        return {
+            "handler": self.name,
+            "checks": self.checks,
+            "matches": self.matches,
+            "match_time": self.match_time,
+            "match_histogram": self.match_histogram.snapshot(),
+            "runs": self.runs,
+            "run_time": self.run_time,
+            "run_histogram": self.run_histogram.snapshot(),
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+        }
+
+
+class HandlerProfiler:
+    """
+    Opt-in dispatch profiler, see `Client(profiler=...)`.
+    Records per message and join handler how often its filters were checked and
+    matched, the time spent in its message regex and matcher, and the wall time,
+    exceptions and cancellations of its runs. Without a profiler the dispatch
+    doesn't take any timings.
+    """
+
+    _log = logging.getLogger("bot.HandlerProfiler")
+
+    def __init__(self, log_interval: float=None, log_level: int=logging.INFO):
+        """
+        :param log_interval: log a summary every this many seconds while the client
+                             is connected, `None` to only collect
+        :param log_level: level of the summary
+        """
+        self.log_interval = log_interval
+        self.log_level = log_level
+        self._stats = {}
+
+    def _get(self, handler: Callable) -> HandlerStats:
+        stats = self._stats.get(handler)
+        if stats is None:
+            stats = self._stats[handler] = HandlerStats(handler)
+        return stats
+
+    def checked(self, handler: Callable, seconds: float, matched: bool) -> None:
+        """
+        The handler's filters were evaluated, taking `seconds`
+        """
+        stats = self._get(handler)
+        stats.checks += 1
+        stats.match_time += seconds
+        stats.match_histogram.add(seconds)
+        if matched:
+            stats.matches += 1
+
+    def timed(self, handler: Callable, run: Callable) -> Callable:
+        """
+        Wrap the coroutine function `run`, which runs `handler`, to record its runs
+        """
+        stats = self._get(handler)
+
+        async def timed_run(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await run(*args, **kwargs)
+            except asyncio.CancelledError:
+                stats.cancelled += 1
+                raise
+            except:
+                stats.errors += 1
+                raise
+            finally:
+                elapsed = perf_counter() - start
+                stats.runs += 1
+                stats.run_time += elapsed
+                stats.run_histogram.add(elapsed)
+
+        return timed_run
+
+    def snapshot(self) -> List[dict]:
+        """
+        Stats of every handler seen so far, most total run time first
+        """
+        stats = sorted(self._stats.values(), key=lambda stats: (stats.run_time, stats.match_time), reverse=True)
+        return [s.snapshot() for s in stats]
+
+    def reset(self) -> None:
+        self._stats.clear()
+
+    def log_snapshot(self) -> None:
+        if not self._log.isEnabledFor(self.log_level):
+            return
+        for s in self.snapshot():
+            self._log.log(self.log_level,
+                          "%s: %d/%d matched in %.6fs, %d runs in %.3fs, %d errors, %d cancelled",
+                          s["handler"], s["matches"], s["checks"], s["match_time"],
+                          s["runs"], s["run_time"], s["errors"], s["cancelled"])
+
+    async def log_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.log_interval)
+            self.log_snapshot()
+
+    def __repr__(self):
+        return "<HandlerProfiler handlers={}>".format(len(self._stats))
@@ -0,0 +1,148 @@
+import asyncio
+from collections import deque
+from typing import List, Optional
+
+
+class IrcProtocol(asyncio.Protocol):
+    """
+    Line splitting `asyncio.Protocol` used by `Client.run` in "protocol" mode.
+    Every chunk received is split into lines in one pass and queued as a batch,
+    so the read loop is only woken once per chunk instead of once per line.
+    Lines are returned as bytes, still including a trailing "\\r" if any.
+    Lines longer than `max_line_length` are dropped and counted in `oversized`.
+    """
+
+    def __init__(self, max_pending: int=64, max_line_length: int=8192):
+        """
+        :param max_pending: number of queued batches after which reading from the
+                            socket is paused until the client catches up
+        :param max_line_length: longest line accepted in bytes, excluding the "\\n".
+                                Defaults to 8 KiB, since IRCv3 message tags allow
+                                lines longer than the 512 bytes of RFC 1459
+        """
+        self.transport = None
+        self._max_pending = max_pending
+        self._max_line_length = max_line_length
+        # chunks of the unterminated last line, joined once its "\n" arrives
+        self._buffer = []
+        self._buffered = 0
+        # the unterminated line grew past the limit, drop it up to the next "\n"
+        self._discarding = False
+        self.oversized = 0
+        self._batches = deque()
+        self._waiter = None
+        self._paused = False
+        self._eof = False
+        self._write_paused = False
+        self._drain_waiter = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        lines = data.split(b"\n")
+        tail = lines.pop()
+        if not lines:
+            self._buffer_partial(tail)
+            return
+        if self._discarding:
+            self._discarding = False
+            del lines[0]
+        elif self._buffer:
+            self._buffer.append(lines[0])
+            if self._buffered + len(lines[0]) > self._max_line_length:
+                self.oversized += 1
+                del lines[0]
+            else:
+                lines[0] = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if len(data) > self._max_line_length:
+            limit = self._max_line_length
+            kept = [line for line in lines if len(line) <= limit]
+            self.oversized += len(lines) - len(kept)
+            lines = kept
+        self._buffer_partial(tail)
+        if not lines:
+            return
+        self._batches.append(lines)
+        if len(self._batches) >= self._max_pending and not self._paused:
+            self._paused = True
+            self.transport.pause_reading()
+        self._wakeup()
+
+    def _buffer_partial(self, data: bytes) -> None:
+        if self._discarding or not data:
+            return
+        self._buffered += len(data)
+        if self._buffered > self._max_line_length:
+            self.oversized += 1
+            self._discarding = True
+            self._buffer = []
+            self._buffered = 0
+            return
+        self._buffer.append(data)
+
+    def eof_received(self) -> bool:
+        self._finish()
+        # let the transport close itself
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._finish()
+        self.resume_writing()
+
+    def pause_writing(self) -> None:
+        self._write_paused = True
+
+    def resume_writing(self) -> None:
+        self._write_paused = False
+        waiter = self._drain_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def drain(self) -> None:
+        """
+        Wait until the transport's write buffer is below its high-water mark
+        """
+        if not self._write_paused:
+            return
+        self._drain_waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self._drain_waiter
+        finally:
+            self._drain_waiter = None
+
+    def _finish(self) -> None:
+        if self._eof:
+            return
+        self._eof = True
+        if self._buffer:
+            # unterminated last line, deliver it like StreamReader.readline does
+            self._batches.append([b"".join(self._buffer)])
+            self._buffer = []
+            self._buffered = 0
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read_batch(self) -> Optional[List[bytes]]:
+        """
+        Wait for the next batch of lines, returns `None` once the connection is closed
+        """
+        while not self._batches:
+            if self._eof:
+                return None
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        batch = self._batches.popleft()
+        if self._paused and len(self._batches) <= self._max_pending // 2:
+            self._paused = False
+            self.transport.resume_reading()
+        return batch
@@ -0,0 +1,332 @@
+from . import command_codes as cc
+
+import asyncio
+from collections import deque
+import time
+
+# Priority lanes of the send queue, lower goes out first
+PRIORITY_CRITICAL = 0
+PRIORITY_CONTROL = 1
+PRIORITY_BULK = 2
+
+_PRIORITIES = {
+    cc.PONG: PRIORITY_CRITICAL,
+    cc.PING: PRIORITY_CRITICAL,
+    cc.PRIVMSG: PRIORITY_BULK,
+    cc.NOTICE: PRIORITY_BULK,
+    # behind everything else, see `Client.quit`
+    cc.QUIT: PRIORITY_BULK,
+}
+
+# commands whose first argument is the channel or nick they're about
+_TARGETED = frozenset((cc.PRIVMSG, cc.NOTICE, cc.JOIN, cc.PART, cc.MODE, cc.TOPIC, cc.KICK))
+
+
+def command_priority(command: str) -> int:
+    """
+    Lane for a command: keepalive traffic is critical, PRIVMSG, NOTICE and QUIT
+    are bulk, everything else (JOIN, PART, MODE, NICK, ...) is control
+    """
+    return _PRIORITIES.get(command, PRIORITY_CONTROL)
+
+
+def command_target(command: str, args: tuple) -> str:
+    """
+    Channel or nick a line with these arguments is about, `None` if there is none
+    """
+    if command in _TARGETED and len(args) > 1:
+        return str(args[1])
+    return None
+
+
+class TokenBucket:
+    """
+    Flood control for outgoing lines.
+    The bucket holds up to `burst` tokens and refills at `rate` tokens per second.
+    Every line costs one token plus one more per `penalty_bytes` bytes of its
+    length, similar to the penalty rules common ircds apply, so long lines
+    drain the bucket faster than short ones.
+    """
+
+    def __init__(self, rate: float=2.0, burst: int=5, penalty_bytes: int=0):
+        """
+        :param rate: tokens (i.e. short lines) per second
+        :param burst: maximum number of tokens that can be spent at once
+        :param penalty_bytes: charge an additional token per this many bytes, 0 to disable
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive, got {}".format(rate))
+        self.rate = rate
+        self.burst = burst
+        self.penalty_bytes = penalty_bytes
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def cost(self, size: int) -> float:
+        if self.penalty_bytes:
+            return 1 + size // self.penalty_bytes
+        return 1
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, size: int) -> float:
+        """
+        Seconds until a line of `size` bytes can be sent without going into debt
+        """
+        self._refill()
+        missing = min(self.cost(size), self.burst) - self._tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
+
+    def consume(self, size: int) -> None:
+        """
+        Take the tokens for a line of `size` bytes. The bucket may go into debt,
+        which delays the following lines.
+        """
+        self._refill()
+        self._tokens -= self.cost(size)
+
+    def __repr__(self):
+        return "<TokenBucket rate={self.rate} burst={self.burst} penalty_bytes={self.penalty_bytes}>" \
+            .format(self=self)
+
+
+class _FifoLane(deque):
+    """
+    Plain FIFO lane, targets are ignored
+    """
+
+    def append(self, line: bytes, target: str=None) -> None:
+        super().append(line)
+
+    def appendleft(self, line: bytes, target: str=None) -> None:
+        super().appendleft(line)
+
+    def popleft(self) -> (bytes, str):
+        return super().popleft(), None
+
+    def depths(self) -> dict:
+        return {}
+
+
+class _FairLane:
+    """
+    Lane with one FIFO per target, served by deficit round robin: each turn a
+    target is credited `quantum` bytes and may send lines as long as its credit
+    lasts, so a target with a long backlog can't starve the others.
+    """
+
+    def __init__(self, quantum: int=512):
+        self.quantum = quantum
+        self._queues = {}
+        self._deficits = {}
+        # targets with queued lines in round robin order, the head is being served
+        self._active = deque()
+        self._credited = False
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def append(self, line: bytes, target: str=None) -> None:
+        queue = self._queues.get(target)
+        if queue is None:
+            queue = self._queues[target] = deque()
+            self._deficits[target] = 0
+            self._active.append(target)
+        queue.append(line)
+        self._len += 1
+
+    def appendleft(self, line: bytes, target: str=None) -> None:
+        """
+        Undo the last `popleft`, refunding the line's size to the target
+        """
+        queue = self._queues.get(target)
+        if queue is None:
+            queue = self._queues[target] = deque()
+            self._deficits[target] = 0
+            self._active.appendleft(target)
+            self._credited = True
+        queue.appendleft(line)
+        self._deficits[target] += len(line)
+        self._len += 1
+
+    def popleft(self) -> (bytes, str):
+        if not self._len:
+            raise IndexError("pop from an empty lane")
+        active = self._active
+        while True:
+            target = active[0]
+            queue = self._queues[target]
+            size = len(queue[0])
+            if self._deficits[target] >= size:
+                break
+            if not self._credited:
+                self._deficits[target] += self.quantum
+                self._credited = True
+            else:
+                active.rotate(-1)
+                self._credited = False
+        self._deficits[target] -= size
+        line = queue.popleft()
+        self._len -= 1
+        if not queue:
+            # targets without backlog don't keep their credit
+            del self._queues[target]
+            del self._deficits[target]
+            active.popleft()
+            self._credited = False
+        return line, target
+
+    def __contains__(self, target: str) -> bool:
+        return target in self._queues
+
+    def depths(self) -> dict:
+        return {target: len(queue) for target, queue in self._queues.items()}
+
+
+class SendQueue:
+    """
+    Bounded queue of encoded lines waiting to be written to the connection, with
+    one lane per priority. `get` always serves the most urgent non-empty lane.
+    Within the bulk lane recipients take turns (see `_FairLane`), the other lanes
+    are FIFO. A control line never passes bulk lines for the same target, it's
+    queued behind them in the bulk lane instead.
+    `put` blocks while the line's lane is full, which slows down producers to the
+    pace the writer (and the flood control) allows; the critical lane is unbounded
+    so keepalive replies never wait for room.
+    """
+
+    def __init__(self, maxsize: int=256, quantum: int=512):
+        """
+        :param maxsize: maximum number of lines per lane, 0 for no limit
+        :param quantum: bytes credited to each recipient per round in the bulk lane
+        """
+        self.maxsize = maxsize
+        self._lanes = (_FifoLane(), _FifoLane(), _FairLane(quantum))
+        self._getter = None
+        self._putters = tuple(deque() for _ in self._lanes)
+        self._urgent = None
+        self._emptied = deque()
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self._lanes)
+
+    def depths(self) -> dict:
+        """
+        Number of queued bulk lines per recipient
+        """
+        return self._lanes[PRIORITY_BULK].depths()
+
+    def full(self, priority: int=PRIORITY_BULK) -> bool:
+        if priority == PRIORITY_CRITICAL:
+            return False
+        return 0 < self.maxsize <= len(self._lanes[priority])
+
+    async def put(self, line: bytes, priority: int=PRIORITY_BULK, target: str=None) -> None:
+        if priority == PRIORITY_CONTROL and target is not None and self._bulk_pending(target):
+            priority = PRIORITY_BULK
+        putters = self._putters[priority]
+        while self.full(priority):
+            putter = asyncio.get_event_loop().create_future()
+            putters.append(putter)
+            try:
+                await putter
+            except:
+                putter.cancel()
+                # pass the wakeup on if we got it but can't use it anymore
+                if not self.full(priority):
+                    self._wakeup_putter(priority)
+                raise
+        self._lanes[priority].append(line, target)
+        self._wakeup(self._getter)
+        urgent = self._urgent
+        if urgent is not None and priority < urgent[0]:
+            self._wakeup(urgent[1])
+
+    def _bulk_pending(self, target: str) -> bool:
+        """
+        Whether a bulk line for `target` is queued or held back by the writer
+        """
+        if target in self._lanes[PRIORITY_BULK]:
+            return True
+        urgent = self._urgent
+        return urgent is not None and urgent[0] == PRIORITY_BULK and urgent[2] == target
+
+    async def wait_empty(self) -> None:
+        """
+        Wait until every queued line has been taken by `get`
+        """
+        while len(self):
+            fut = asyncio.get_event_loop().create_future()
+            self._emptied.append(fut)
+            await fut
+
+    def requeue(self, line: bytes, priority: int, target: str=None) -> None:
+        """
+        Put a line taken by `get` back at the head of its lane
+        """
+        self._lanes[priority].appendleft(line, target)
+
+    async def get(self) -> (bytes, int, str):
+        """
+        Take the next line, returns `(line, priority, target)`
+        """
+        while True:
+            item = self.get_nowait()
+            if item is not None:
+                return item
+            self._getter = asyncio.get_event_loop().create_future()
+            try:
+                await self._getter
+            finally:
+                self._getter = None
+
+    def get_nowait(self) -> (bytes, int, str):
+        """
+        Like `get`, but returns `None` instead of waiting if the queue is empty
+        """
+        for priority, lane in enumerate(self._lanes):
+            if len(lane):
+                line, target = lane.popleft()
+                self._wakeup_putter(priority)
+                if not len(self):
+                    while self._emptied:
+                        self._wakeup(self._emptied.popleft())
+                return line, priority, target
+        return None
+
+    async def wait_urgent(self, priority: int, timeout: float, target: str=None) -> bool:
+        """
+        Wait up to `timeout` seconds for a line more urgent than `priority`,
+        returns whether one is queued. `target` is the held back line's, control
+        lines for it queue up behind it meanwhile.
+        """
+        if any(len(lane) for lane in self._lanes[:priority]):
+            return True
+        fut = asyncio.get_event_loop().create_future()
+        self._urgent = (priority, fut, target)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._urgent = None
+        return True
+
+    @staticmethod
+    def _wakeup(fut: asyncio.Future) -> None:
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    def _wakeup_putter(self, priority: int) -> None:
+        putters = self._putters[priority]
+        while putters:
+            putter = putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+                return
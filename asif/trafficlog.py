@@ -0,0 +1,66 @@
+import logging
+
+IN = "in"
+OUT = "out"
+
+
+class TrafficLog:
+    """
+    Sampled wire log for production, see `Client(traffic_log=...)`.
+    Every line received and queued for sending is counted, but only every `sample_every`-th
+    line in each direction is logged. Records carry the line's fields as
+    attributes (`irc_direction`, `irc_command`, `irc_target`, `irc_size`,
+    `irc_line` and `irc_seq`, the line's number in its direction) for
+    structured formatters, e.g. JSON ones; the message itself is a plain
+    one-line summary.
+    """
+
+    def __init__(self, sample_every: int=100, logger: logging.Logger=None, level: int=logging.INFO,
+                 encoding: str="utf-8"):
+        """
+        :param sample_every: log one in this many lines per direction, 1 to log all
+        :param logger: logger to log to, "bot.traffic" by default
+        :param level: level of the records
+        :param encoding: encoding to decode logged lines with, undecodable bytes are replaced
+        """
+        if sample_every < 1:
+            raise ValueError("sample_every must be positive, got {}".format(sample_every))
+        self.sample_every = sample_every
+        self.logger = logger if logger is not None else logging.getLogger("bot.traffic")
+        self.level = level
+        self.encoding = encoding
+        self.lines = {IN: 0, OUT: 0}
+        self.bytes = {IN: 0, OUT: 0}
+
+    def received(self, line: bytes, command: str, target: str=None) -> None:
+        self._record(IN, line, command, target)
+
+    def sent(self, line: bytes, command: str, target: str=None) -> None:
+        self._record(OUT, line, command, target)
+
+    def _record(self, direction: str, line: bytes, command: str, target: str) -> None:
+        seq = self.lines[direction] + 1
+        self.lines[direction] = seq
+        self.bytes[direction] += len(line)
+        if seq % self.sample_every or not self.logger.isEnabledFor(self.level):
+            return
+        text = line.decode(self.encoding, "replace").rstrip("\r\n")
+        self.logger.log(self.level, "%s %s", "->" if direction == IN else "<-", text, extra={
+            "irc_direction": direction,
+            "irc_command": command,
+            "irc_target": target,
+            "irc_size": len(line),
+            "irc_line": text,
+            "irc_seq": seq,
+        })
+
+    def stats(self) -> dict:
+        return {
+            "lines_in": self.lines[IN],
+            "lines_out": self.lines[OUT],
+            "bytes_in": self.bytes[IN],
+            "bytes_out": self.bytes[OUT],
+        }
+
+    def __repr__(self):
+        return "<TrafficLog sample_every={self.sample_every}>".format(self=self)
@@ -1,3 +1,7 @@
+import codecs
+from typing import Iterator
+
+
 def no_highlight(nick: str) -> str:
     """
     Inserts a Unicode Zero Width Space into nick to prevent highlights
@@ -9,3 +13,76 @@ def bold(text: str) -> str:
 
 def yellow(text: str) -> str:
     return "\x03" + "08" + text + "\x0f"
+
+def split_encoded(text: str, max_bytes: int, encoding: str="utf-8") -> Iterator[str]:
+    """
+    Split text into chunks of at most max_bytes bytes when encoded, preferably
+    at spaces (which are dropped at the split), otherwise on character
+    boundaries. For UTF-8 the text is encoded once and each byte is looked at a
+    constant number of times, other encodings are measured character by
+    character (see `_split_chars`).
+    """
+    data = text.encode(encoding)
+    if len(data) <= max_bytes:
+        yield text
+        return
+    if codecs.lookup(encoding).name != "utf-8":
+        yield from _split_chars(text, max_bytes, encoding)
+        return
+    start, size = 0, len(data)
+    while start < size:
+        end = start + max_bytes
+        if end >= size:
+            yield data[start:].decode(encoding)
+            return
+        # don't cut into a multi-byte sequence: back off continuation bytes
+        while end > start and data[end] & 0xC0 == 0x80:
+            end -= 1
+        if end == start:
+            raise ValueError("max_bytes={} can't hold a single character".format(max_bytes))
+        space = data.rfind(b" ", start + 1, end + 1)
+        if space > start:
+            chunk, start = data[start:space], space + 1
+        else:
+            chunk, start = data[start:end], end
+        yield chunk.decode(encoding)
+
+def _split_chars(text: str, max_bytes: int, encoding: str) -> Iterator[str]:
+    """
+    `split_encoded` for encodings other than UTF-8. Their byte slices don't
+    necessarily decode on their own (e.g. ISO-2022-JP switches character sets
+    with escape sequences), so chunks are measured with an incremental encoder,
+    including the bytes that end a chunk. Each character is encoded once, plus
+    once more if it's carried over to the next chunk after a split at a space.
+    """
+    encoder = codecs.getincrementalencoder(encoding)()
+    start = used = i = 0
+    space = -1
+    while i < len(text):
+        char_size = len(encoder.encode(text[i]))
+        state = encoder.getstate()
+        end_size = len(encoder.encode("", True))
+        encoder.setstate(state)
+        if used + char_size + end_size <= max_bytes:
+            used += char_size
+            if text[i] == " " and i > start:
+                space = i
+            i += 1
+            continue
+        if text[i] == " " and i > start:
+            space = i
+        if space > start:
+            yield text[start:space]
+            start = space + 1
+            i = max(i, start)
+        elif i > start:
+            yield text[start:i]
+            start = i
+        else:
+            raise ValueError("max_bytes={} can't hold a single character".format(max_bytes))
+        # measure what's carried over afresh, a chunk starts in the initial state
+        encoder.reset()
+        used = len(encoder.encode(text[start:i]))
+        space = text.rfind(" ", start + 1, i)
+    if start < len(text):
+        yield text[start:]
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Compare the per-message cost of the previous closure-chain on_message matchers
+with the generated ones, for a few typical registrations. Both are called on a
+message they accept and one they reject.
+
+Usage: python benchmarks/bench_matcher.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from asif import Channel, Client, Message, User  # noqa: E402
+
+
+def legacy_matcher(message=None, channel=None, sender=None, matcher=None, notice=None):
+    # `Client.on_message` matchers before they were generated, without the
+    # message regex, which none of the registrations below use
+    matchers = []
+
+    if notice is not None:
+        def notice_matcher(msg):
+            return msg.notice == notice
+        matchers.append(notice_matcher)
+
+    if matcher:
+        matchers.append(matcher)
+
+    if isinstance(message, str):
+        def matcher(msg):
+            return msg.text == message
+        matchers.append(matcher)
+
+    if isinstance(sender, str):
+        def matcher(msg):
+            return msg.sender.name == sender
+        matchers.append(matcher)
+    elif hasattr(sender, "search"):
+        def matcher(msg):
+            m = sender.search(msg.sender.name)
+            if m is not None:
+                return m.groupdict()
+        matchers.append(matcher)
+
+    if isinstance(channel, str):
+        def matcher(msg):
+            return isinstance(msg.recipient, Channel) \
+                   and msg.recipient.name == channel
+        matchers.append(matcher)
+    elif hasattr(channel, "search"):
+        def matcher(msg):
+            if not isinstance(msg.recipient, Channel):
+                return
+            m = channel.search(msg.recipient.name)
+            if m is not None:
+                return m.groupdict()
+        matchers.append(matcher)
+
+    def message_matcher(msg):
+        fn_kwargs = {}
+        for m in matchers:
+            ret = m(msg)
+            if ret is None or ret is False:
+                return
+            if isinstance(ret, dict):
+                fn_kwargs.update(ret)
+        return fn_kwargs
+
+    return message_matcher
+
+
+REGISTRATIONS = [
+    ("text", dict(message="!ping")),
+    ("channel", dict(channel="#chan")),
+    ("text+channel+notice", dict(message="!ping", channel="#chan", notice=False)),
+    ("sender regex", dict(sender=re.compile("^(?P<nick>al)"), channel="#chan")),
+    ("custom matcher", dict(channel="#chan", matcher=lambda msg: msg.text.startswith("!"))),
+]
+
+
+def main():
+    client = Client("localhost", 6667)
+    sender = User("alice", client, "alice!a@host")
+    accepted = Message(sender, client.get_channel("#chan"), "!ping")
+    rejected = Message(sender, client.get_channel("#other"), "hello")
+
+    number = 200000
+    print("{:>22} {:>15} {:>15} {:>8}".format("registration", "legacy ns/msg", "compiled ns/msg", "speedup"))
+    for name, filters in REGISTRATIONS:
+        legacy = legacy_matcher(**filters)
+        compiled = client._build_message_matcher(**filters)[0]
+        for message in (accepted, rejected):
+            assert (legacy(message) is None) == (compiled(message) is None)
+
+        def run(fn):
+            return timeit.timeit(lambda: (fn(accepted), fn(rejected)), number=number) / (2 * number) * 1e9
+
+        t_legacy = run(legacy)
+        t_compiled = run(compiled)
+        print("{:>22} {:>15.0f} {:>15.0f} {:>7.1f}x".format(name, t_legacy, t_compiled, t_legacy / t_compiled))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare the linear on_message handler scan with the indexed dispatch as the
+number of registered handlers grows.
+
+Usage: python benchmarks/bench_on_message.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from asif import Client, Message  # noqa: E402
+
+
+def make_client(num_handlers: int) -> Client:
+    client = Client("localhost", 6667)
+
+    async def handler(message, **kwargs):
+        pass
+
+    for i in range(num_handlers):
+        kind = i % 10
+        if kind < 3:
+            client.on_message("!cmd{}".format(i))(handler)
+        elif kind < 6:
+            client.on_message(channel="#chan{}".format(i))(handler)
+        elif kind < 9:
+            client.on_message(sender="nick{}".format(i))(handler)
+        else:
+            client.on_message(re.compile("^!re{}".format(i)))(handler)
+    return client
+
+
+def linear(handlers: list, message: Message) -> int:
+    # the handler list before the index, iterating the index itself costs a
+    # merge of all its buckets
+    matched = 0
+    for mh in handlers:
+        if mh.matcher(message) is not None:
+            matched += 1
+    return matched
+
+
+def indexed(client: Client, message: Message) -> int:
+    matched = 0
+    channel = message.recipient.name
+    for mh in client._on_message_handlers.candidates(message.text, channel, message.sender.name):
+        if mh.matcher(message) is not None:
+            matched += 1
+    return matched
+
+
+def main():
+    number = 2000
+    print("{:>8} {:>14} {:>14} {:>8}".format("handlers", "linear us/msg", "indexed us/msg", "speedup"))
+    for num_handlers in (10, 100, 500, 1000, 5000):
+        client = make_client(num_handlers)
+        handlers = list(client._on_message_handlers)
+        message = Message(client.get_user("nick7!u@h"), client.get_channel("#chan4"), "!cmd0")
+        assert linear(handlers, message) == indexed(client, message)
+        t_linear = timeit.timeit(lambda: linear(handlers, message), number=number)
+        t_indexed = timeit.timeit(lambda: indexed(client, message), number=number)
+        print("{:>8} {:>14.2f} {:>14.2f} {:>7.1f}x".format(
+            num_handlers, t_linear / number * 1e6, t_indexed / number * 1e6, t_linear / t_indexed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare the previous str-based `Client._parsemsg` with `parse_line` on
+captured traffic (benchmarks/traffic.irc).
+Both variants read the verb of every line and the text of every PRIVMSG/NOTICE.
+
+Usage: python benchmarks/bench_parser.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from asif.parser import IrcMessage, parse_line  # noqa: E402
+
+
+def legacy_parsemsg(msg: str) -> IrcMessage:
+    # `Client._parsemsg` before parse_line was introduced
+    if not msg:
+        return
+    prefix = None
+    if msg[0] == ":":
+        prefix, msg = msg[1:].split(" ", 1)
+    if " :" in msg:
+        msg, rest = msg.split(" :", 1)
+        args = msg.split() + [rest]
+    else:
+        args = msg.split()
+    return IrcMessage(prefix, tuple(args))
+
+
+def load_traffic() -> list:
+    path = os.path.join(os.path.dirname(__file__), "traffic.irc")
+    with open(path, "rb") as f:
+        # stored with "\x01" escaped to keep the file printable
+        return [line.replace(b"\\x01", b"\x01").rstrip(b"\n") + b"\r\n" for line in f]
+
+
+def parse_legacy(lines: list) -> int:
+    n = 0
+    for line in lines:
+        msg = legacy_parsemsg(line.decode("utf-8").strip("\r\n"))
+        if msg.args[0] in ("PRIVMSG", "NOTICE"):
+            n += len(msg.args[2])
+    return n
+
+
+def parse_bytes(lines: list) -> int:
+    n = 0
+    for line in lines:
+        msg = parse_line(line, "utf-8")
+        if msg.args[0] in ("PRIVMSG", "NOTICE"):
+            n += len(msg.args[2])
+    return n
+
+
+def main():
+    lines = load_traffic() * 100
+    assert parse_legacy(lines) == parse_bytes(lines)
+    number = 20
+    t_legacy = timeit.timeit(lambda: parse_legacy(lines), number=number)
+    t_bytes = timeit.timeit(lambda: parse_bytes(lines), number=number)
+    total = len(lines) * number
+    print("lines per run: {}".format(len(lines)))
+    print("legacy _parsemsg: {:.2f} us/line".format(t_legacy / total * 1e6))
+    print("parse_line:       {:.2f} us/line".format(t_bytes / total * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Compare line-by-line writes with coalesced writes of the outgoing queue.
+A number of handlers reply at the same time, like they do after a busy
+message burst, over a real loopback connection to a server discarding
+everything it receives.
+
+Usage: python benchmarks/bench_send.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from asif import Client  # noqa: E402
+from asif.protocol import IrcProtocol  # noqa: E402
+from asif.sendqueue import SendQueue  # noqa: E402
+
+
+async def discard(reader, writer):
+    while await reader.read(65536):
+        pass
+
+
+async def run(coalesce: bool, handlers: int, lines: int) -> (float, int):
+    server = await asyncio.start_server(discard, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    loop = asyncio.get_event_loop()
+    client = Client("127.0.0.1", port, coalesce_writes=coalesce)
+    transport, protocol = await loop.create_connection(IrcProtocol, "127.0.0.1", port)
+
+    writes = 0
+    write = transport.write
+
+    def counting_write(data):
+        nonlocal writes
+        writes += 1
+        write(data)
+
+    transport.write = counting_write
+    client._writer = transport
+    client._send_queue = SendQueue(0)
+    writer = asyncio.ensure_future(client._write_loop(protocol.drain))
+
+    async def handler(i):
+        for j in range(lines):
+            await client.message("#chan{}".format(i % 10), "reply {} of handler {}".format(j, i))
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handler(i) for i in range(handlers)))
+    while len(client._send_queue):
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+
+    writer.cancel()
+    transport.close()
+    # give the server a chance to see the EOF
+    await asyncio.sleep(0.1)
+    server.close()
+    await server.wait_closed()
+    return elapsed, writes
+
+
+def main():
+    handlers, lines = 200, 50
+    total = handlers * lines
+    print("{} handlers sending {} lines each".format(handlers, lines))
+    for coalesce in (False, True):
+        elapsed, writes = asyncio.run(run(coalesce, handlers, lines))
+        print("coalesce={!s:5} {:8.2f} us/line {:6} transport writes".format(
+            coalesce, elapsed / total * 1e6, writes))
+
+
+if __name__ == "__main__":
+    main()
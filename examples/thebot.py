@@ -24,7 +24,7 @@ async def on_connect():
     await bot.join("#asif-test")
 
 
-@bot.on_message(re.compile("youtube\.com|youtu\.be"))
+@bot.on_message(re.compile("youtube\.com|youtu\.be"), timeout=10)
 async def youtube_info(message):
     if not hasattr(config, "youtube_api_key"):
         return
@@ -81,7 +81,7 @@ async def cli_input():
         msg = bot._parsemsg(inp)
         await bot._send(*msg.args, prefix=msg.prefix)
 
-bot._bg(cli_input())
+bot._bg(cli_input(), detached=True)
 loop = asyncio.get_event_loop()
 while True:
     try: